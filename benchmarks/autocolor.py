@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+
+"""
+Autocolor clusters rebanding benchmark.
+Compare legacy point list concatenation with running totals banding on a set of images.
+Vectorized engine result is checked against reference one first, on synthetic images
+with clipped (255 valued) channels and on given files.
+Usage:
+$ python3 benchmarks/autocolor.py cover1.jpg cover2.png ...
+"""
+
+import os
+import sys
+import random
+import timeit
+import gi
+
+gi.require_version('Gtk', '3.0')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PIL import Image
+from cavalcade.autocolor import get_points, allocate, points_color, numpy_color
+
+OPTIONS = dict(bands=256, window=8, saturation_min=0.25, value_min=0.25)
+ISIZES = ((160, 90), (640, 360))
+REPEAT = 5
+
+
+class LegacyCluster:
+	"""Group of color points as it was before running totals"""
+	# noinspection PyDefaultArgument
+	def __init__(self, points = []):
+		self.points = []
+		self.mass = 0
+		for p in points:
+			self.add(p)
+
+	def add(self, point):
+		self.points.append(point)
+		self.mass += point.count
+
+
+def legacy_allocate(points, n=16, window=4):
+	"""Split points to groups the legacy way"""
+	band = 1 / n
+	clusters = [LegacyCluster() for _ in range(n)]
+	for point in points:
+		i = int(point.hsv[0] // band)
+		clusters[i].add(point)
+	clusters_l = clusters + clusters[:window - 1]
+	bands = [clusters_l[i:i + window] for i in range(n)]
+	rebanded = [LegacyCluster(sum([c.points for c in band], [])) for band in bands]
+	return rebanded
+
+
+def measure(func, points):
+	"""Average time for single call in milliseconds"""
+	call = lambda: func(points, OPTIONS["bands"], OPTIONS["window"])  # noqa: E731
+	return timeit.timeit(call, number=REPEAT) / REPEAT * 1e3
+
+
+def synthetic_images():
+	"""Images with fully saturated channels, where byte overflow mistakes show up"""
+	img = Image.new("RGB", (160, 90), (0, 0, 200))
+	img.paste((255, 0, 0), (0, 0, 100, 90))
+	yield "red and blue", img
+
+	rng = random.Random(1)
+	for i in range(20):
+		data = bytes(rng.choice((0, 255, rng.randrange(256))) for _ in range(160 * 90 * 3))
+		yield "random clipped %d" % i, Image.frombytes("RGB", (160, 90), data)
+
+
+def verify(files):
+	"""Check vectorized engine gives the same color as reference one"""
+	images = list(synthetic_images())
+	for file_ in files:
+		img = Image.open(file_).convert("RGB")
+		img.thumbnail(ISIZES[0])
+		images.append((os.path.basename(file_), img))
+
+	failed = 0
+	for name, img in images:
+		expected, result = points_color(img, OPTIONS), numpy_color(img, OPTIONS)
+		if any(abs(a - b) > 1e-9 for a, b in zip(expected, result)):
+			failed += 1
+			print("Engines mismatch on %s: points %s, numpy %s" % (name, expected, result))
+	print("Engines check: %d of %d images match" % (len(images) - failed, len(images)))
+	return not failed
+
+
+def run(files):
+	if not verify(files):
+		sys.exit(1)
+	if not files:
+		print(__doc__)
+		return
+
+	print("%-30s %10s %8s %12s %12s %8s" % ("image", "size", "points", "before, ms", "after, ms", "speedup"))
+	for file_ in files:
+		for isize in ISIZES:
+			img = Image.open(file_).convert("RGB")
+			img.thumbnail(isize)
+			points = get_points(img, OPTIONS)
+
+			before = measure(legacy_allocate, points)
+			after = measure(allocate, points)
+			print("%-30s %10s %8d %12.2f %12.2f %7.2fx" % (
+				os.path.basename(file_)[-30:], "%dx%d" % img.size, len(points), before, after, before / after
+			))
+
+
+if __name__ == "__main__":
+	run(sys.argv[1:])
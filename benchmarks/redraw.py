@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+
+"""
+Spectrum redraw micro benchmark.
+Compare per frame cost of legacy bar by bar geometry calculation
+with cached geometry renderer (height mapping and damage calculation included).
+Usage:
+$ python3 benchmarks/redraw.py
+"""
+
+import os
+import sys
+import random
+import timeit
+import gi
+
+gi.require_version('Gtk', '3.0')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cavalcade.drawing import Spectrum
+
+BARS = (20, 100, 200)
+SIZE = (1920, 1080)
+REPEAT = 2000
+
+
+class NullContext:
+	"""Cairo context stub to measure python side only"""
+	def set_source_rgba(self, *args):
+		pass
+
+	def rectangle(self, *args):
+		pass
+
+	def fill(self):
+		pass
+
+	def clip_extents(self):
+		return (0, 0) + SIZE
+
+
+class FakeArea:
+	"""Drawing area stub with fixed size"""
+	def connect(self, *args):
+		pass
+
+	def add_events(self, *args):
+		pass
+
+	def get_allocated_width(self):
+		return SIZE[0]
+
+	def get_allocated_height(self):
+		return SIZE[1]
+
+	def queue_draw(self):
+		pass
+
+	def queue_draw_area(self, *args):
+		pass
+
+
+def cairo_context():
+	"""Get real cairo context if available"""
+	try:
+		import cairo
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *SIZE)
+		return cairo.Context(surface)
+	except ImportError:
+		return None
+
+
+def legacy_redraw(spectrum, cr):
+	"""Spectrum drawing as it was done before geometry caching"""
+	cr.set_source_rgba(*spectrum.color)
+
+	dx = spectrum.config["offset"]["left"]
+	for i, value in enumerate(spectrum.audio_sample):
+		width = spectrum.sizes.bar.width + int(i < spectrum.sizes.wcpi)
+		height = max(spectrum.sizes.bar.height * min(spectrum.config["draw"]["scale"] * value, 1), spectrum.sizes.zero)
+		cr.rectangle(dx, spectrum.sizes.area.height, width, - height)
+		dx += width + spectrum.sizes.padding
+	cr.fill()
+
+
+def build_spectrum(bars):
+	"""Create spectrum drawing object without real widget"""
+	config = dict(
+		draw = dict(padding=5, zero=4, silence=10, scale=1.0),
+		offset = dict(left=5, right=5, top=5, bottom=5),
+		color = dict(auto=False, fg=(0.5, 0.5, 0.5, 0.5), autofg=None),
+	)
+	return Spectrum(config, dict(general=dict(bars=bars)), area=FakeArea())
+
+
+def measure(func, spectrum, cr):
+	"""Average time for single frame in microseconds"""
+	samples = [[random.random() for _ in range(spectrum.sizes.number)] for _ in range(2)]
+	counter = iter(range(REPEAT))
+
+	def frame():
+		spectrum.audio_sample = samples[next(counter) % 2]
+		func(spectrum, cr)
+
+	return timeit.timeit(frame, number=REPEAT) / REPEAT * 1e6
+
+
+def cached_redraw(spectrum, cr):
+	"""Spectrum drawing with cached geometry"""
+	spectrum.invalidate()
+	spectrum.redraw(None, cr)
+
+
+def run():
+	contexts = [("python", NullContext())]
+	cr = cairo_context()
+	if cr is not None:
+		contexts.append(("cairo", cr))
+
+	print("%-8s %6s %12s %12s %8s" % ("context", "bars", "before, us", "after, us", "speedup"))
+	for name, cr in contexts:
+		for bars in BARS:
+			spectrum = build_spectrum(bars)
+			before = measure(legacy_redraw, spectrum, cr)
+			after = measure(cached_redraw, spectrum, cr)
+			print("%-8s %6d %12.1f %12.1f %7.2fx" % (name, bars, before, after, before / after))
+
+
+if __name__ == "__main__":
+	run()
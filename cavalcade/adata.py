@@ -2,6 +2,7 @@
 import os
 import pickle
 
+from collections import OrderedDict
 from cavalcade.logger import logger, debuginfo
 
 
@@ -52,6 +53,41 @@ class SavedColors(Storage):
 		logger.debug("Saved colors:\n%s", self.colors)
 
 
+class ColorCache(Storage):
+	"""Automatically calculated colors keyed by image content hash and analyzer options"""
+	def __init__(self, mainapp, limit=4096):
+		super().__init__(mainapp, "autocolors")
+		self.limit = limit
+		self.colors = OrderedDict()
+
+		if os.path.isfile(self.store):
+			try:
+				with open(self.store, "rb") as fp:
+					self.colors = pickle.load(fp)
+			except Exception:
+				logger.exception("Fail to load autocolor cache")
+
+		logger.debug("Autocolor cache loaded, %d items", len(self.colors))
+
+	def find_color(self, key):
+		color = self.colors.get(key)
+		if color is not None:
+			self.colors.move_to_end(key)
+		return color
+
+	def add_color(self, key, color):
+		self.colors[key] = color
+		self.colors.move_to_end(key)
+		while len(self.colors) > self.limit:
+			self.colors.popitem(last=False)
+
+	def save(self):
+		"""Save calculated colors"""
+		with open(self.store, "wb") as fp:
+			pickle.dump(self.colors, fp)
+		logger.debug("Autocolor cache saved, %d items", len(self.colors))
+
+
 class AudioData(Storage):
 	"""Player session management helper"""
 	def __init__(self, mainapp):
@@ -81,7 +117,7 @@ class AudioData(Storage):
 		"""Save current playlist"""
 		if self._mainapp.imported.gstreamer:
 			with open(self.store, "r+b") as fp:
-				playdata = {"list": self._mainapp.player.playlist, "queue": self._mainapp.player.playqueue}
+				playdata = {"list": self._mainapp.player.playlist, "queue": list(self._mainapp.player.playqueue)}
 				if playdata["list"]:
 					logger.debug("File list to save:\n%s" % str(playdata))
 					pickle.dump(playdata, fp)
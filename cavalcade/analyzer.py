@@ -0,0 +1,366 @@
+# -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+import re
+import array
+import subprocess
+import collections
+import gi
+gi.require_version('Gst', '1.0')
+
+from gi.repository import Gst, GLib
+from cavalcade.cava import SpectrumSource
+from cavalcade.logger import logger
+
+Gst.init(None)
+
+# PyGObject can't unpack GstValueList, so spectrum magnitudes are parsed from structure string
+MAGNITUDE_PATTERN = re.compile(r"magnitude=\(float\)\{([^}]*)\}")
+
+
+def default_monitor():
+	"""Get monitor source name for default PulseAudio (or PipeWire) sink"""
+	try:
+		sink = subprocess.check_output(["pactl", "get-default-sink"], stderr=subprocess.DEVNULL, timeout=2)
+		return sink.decode().strip() + ".monitor"
+	except Exception:
+		logger.warning("Fail to detect default audio sink monitor, capture will use default input")
+		return None
+
+
+class BarMapper:
+	"""
+	Spectrum to bars converter which mimics cava output.
+	Bands are grouped into logarithmic frequency ranges between cutoff frequencies,
+	then equalizer, sensitivity and smoothing filters are applied.
+	"""
+	MONSTERCAT_FACTOR = 1.5
+
+	def __init__(self, cavaconfig, bands, rate, threshold):
+		general, smoothing = cavaconfig["general"], cavaconfig["smoothing"]
+		self.bars = general["bars"]
+		self.threshold = threshold
+
+		# stereo mode shows mirrored spectrum like cava does, low frequencies in the middle
+		if cavaconfig["output"]["channels"] == "stereo":
+			half = self.bars // 2
+			number = self.bars - half
+			self.layout = [half - 1 - i if i < half else i - half for i in range(self.bars)]
+		else:
+			number = self.bars
+			self.layout = list(range(self.bars))
+
+		# frequency ranges
+		low = general["lower_cutoff_freq"]
+		high = min(general["higher_cutoff_freq"], rate / 2)
+		width = rate / 2 / bands
+		edges = [low * (high / low) ** (i / number) for i in range(number + 1)]
+
+		self.ranges = []
+		start = 0
+		for i in range(number):
+			first = min(max(int(edges[i] / width), start), bands - 1)
+			last = min(max(int(edges[i + 1] / width), first + 1), bands)
+			self.ranges.append((first, last))
+			start = last
+
+		eq = cavaconfig["eq"] or [1.0]
+		self.eq = [eq[int(i * len(eq) / number)] for i in range(number)]
+
+		# filters
+		self.sens = general["sensitivity"] / 100
+		self.autosens = general["autosens"]
+		self.gravity = smoothing["gravity"] / 100 * 0.0005 * (60 / general["framerate"]) ** 2.5
+		self.integral = min(smoothing["integral"] / 100, 0.99)
+		self.ignore = smoothing["ignore"] / 100
+		self.monstercat = smoothing["monstercat"]
+
+		self.values = [0.0] * number
+		self.memory = [0.0] * number
+		self.last = [0.0] * number
+		self.peak = [0.0] * number
+		self.fall = [0] * number
+
+	def process(self, magnitudes, sample):
+		"""Fill sample with bar values calculated from band magnitudes in decibels"""
+		norm = -self.threshold
+		values = self.values
+		for i, (first, last) in enumerate(self.ranges):
+			level = sum(magnitudes[first:last]) / (last - first)
+			values[i] = max((level + norm) / norm, 0) * self.eq[i] * self.sens
+
+		if self.monstercat:
+			self._monstercat(values)
+
+		overshoot, is_silent = False, True
+		for i, value in enumerate(values):
+			# falloff
+			if self.gravity > 0:
+				if value < self.last[i]:
+					value = max(self.peak[i] - self.gravity * self.fall[i] ** 2, 0)
+					self.fall[i] += 1
+				else:
+					self.peak[i] = value
+					self.fall[i] = 0
+				self.last[i] = value
+
+			# averaging
+			value = self.memory[i] = self.memory[i] * self.integral + value * (1 - self.integral)
+
+			if value < self.ignore:
+				value = 0
+			if value > 1:
+				overshoot = True
+				value = 1
+			is_silent = is_silent and value == 0
+			values[i] = value
+
+		# automatic sensitivity adjustment
+		if self.autosens:
+			if overshoot:
+				self.sens *= 0.985
+			elif not is_silent:
+				self.sens *= 1.002
+
+		for i, j in enumerate(self.layout):
+			sample[i] = values[j]
+
+	def _monstercat(self, values):
+		"""Smooth spectrum by lifting neighbours of each peak with decaying value"""
+		factor = self.MONSTERCAT_FACTOR
+		for i in range(1, len(values)):
+			values[i] = max(values[i], values[i - 1] / factor)
+		for i in range(len(values) - 2, -1, -1):
+			values[i] = max(values[i], values[i + 1] / factor)
+
+
+class Analyzer(SpectrumSource):
+	"""
+	Built-in spectrum analyzer.
+	Capture system audio with gstreamer and produce bars compatible with cava wrapper output.
+	"""
+	NONE = 0
+	RUNNING = 1
+	CLOSING = 3
+	SUSPENDED = 4
+
+	BANDS = 512
+	RATE = 44100
+	THRESHOLD = -70
+
+	def __init__(self, mainapp):
+		super().__init__(mainapp)
+		self.cavaconfig = mainapp.cavaconfig
+		self.device = mainapp.config["misc"]["capture_device"]
+		self.state = self.NONE
+		self.is_paused = False
+		self.pipeline = None
+		self.mapper = None
+
+	def _build_pipeline(self):
+		if Gst.ElementFactory.find("pulsesrc") is not None:
+			device = self.device or default_monitor()
+			source = "pulsesrc" + (' device="%s"' % device if device else "")
+		else:
+			source = "autoaudiosrc"
+
+		description = (
+			"%s ! audioconvert ! audioresample ! audio/x-raw,rate=%d ! "
+			"spectrum bands=%d threshold=%d interval=%d post-messages=true message-magnitude=true ! "
+			"fakesink sync=false"
+		) % (source, self.RATE, self.BANDS, self.THRESHOLD, Gst.SECOND // self.cavaconfig["general"]["framerate"])
+		logger.debug("Launching spectrum pipeline: %s", description)
+
+		self.pipeline = Gst.parse_launch(description)
+		bus = self.pipeline.get_bus()
+		bus.set_sync_handler(self._on_sync_message)
+
+	def _on_sync_message(self, bus, message):
+		"""Handle spectrum messages directly in streaming thread"""
+		if message.type == Gst.MessageType.ELEMENT:
+			structure = message.get_structure()
+			if structure is not None and structure.get_name() == "spectrum":
+				match = MAGNITUDE_PATTERN.search(structure.to_string())
+				if match:
+					stamp = GLib.get_monotonic_time()
+					magnitudes = [float(value) for value in match.group(1).split(",")]
+					self.mapper.process(magnitudes, self.mailbox.back)
+					if self.timing.enabled:
+						self.timing.add("decode", GLib.get_monotonic_time() - stamp)
+					self._publish(stamp)
+				return Gst.BusSyncReply.DROP
+		elif message.type == Gst.MessageType.ERROR:
+			err, debug = message.parse_error()
+			logger.error("Spectrum capture error %s\n%s" % (err, debug))
+			GLib.idle_add(self._on_stop)
+		return Gst.BusSyncReply.PASS
+
+	def _on_stop(self):
+		if self.pipeline is not None:
+			self.pipeline.set_state(Gst.State.NULL)
+		self.mailbox.log_stats()
+		self.state = self.NONE
+
+	def start(self):
+		"""Start audio capture"""
+		bars = self.cavaconfig["general"]["bars"]
+		self.mapper = BarMapper(self.cavaconfig, self.BANDS, self.RATE, self.THRESHOLD)
+		self.mailbox.setup(lambda: array.array("d", bytes(8 * bars)))
+
+		try:
+			self._build_pipeline()
+			self.pipeline.set_state(Gst.State.PAUSED if self.is_paused else Gst.State.PLAYING)
+			self.state = self.SUSPENDED if self.is_paused else self.RUNNING
+		except Exception:
+			logger.exception("Fail to launch spectrum pipeline")
+
+	def pause(self):
+		"""Suspend audio capture while spectrum is provided by another source"""
+		self.is_paused = True
+		if self.state == self.RUNNING:
+			self.pipeline.set_state(Gst.State.PAUSED)
+			self.state = self.SUSPENDED
+
+	def resume(self):
+		"""Continue suspended audio capture"""
+		self.is_paused = False
+		if self.state == self.SUSPENDED:
+			self.pipeline.set_state(Gst.State.PLAYING)
+			self.state = self.RUNNING
+
+	def restart(self):
+		"""Restart audio capture with new settings"""
+		logger.debug("Restarting spectrum pipeline...")
+		if self.pipeline is not None:
+			self.pipeline.set_state(Gst.State.NULL)
+		self.start()
+
+	def close(self):
+		"""Stop audio capture"""
+		self.state = self.CLOSING
+		if self.pipeline is not None:
+			self.pipeline.set_state(Gst.State.NULL)
+
+
+class PlayerSpectrum(SpectrumSource):
+	"""
+	Spectrum of audio played by built-in player.
+	Spectrum element works as playbin audio filter, so no capture round trip is needed.
+	Frames are shown at their pipeline clock time, external spectrum source is suspended meanwhile.
+	"""
+	def __init__(self, mainapp, playbin):
+		super().__init__(mainapp, attach=False)  # drawing source is switched on playback
+		self._mainapp = mainapp
+		self.cavaconfig = mainapp.cavaconfig
+		self.playbin = playbin
+
+		self.mapper = None
+		self.rate = None
+		self.frames = collections.deque()
+		self.timer = None
+		self.is_scheduling = False  # idle call to _schedule is queued
+		self.is_active = False
+		self._setup_mailbox()
+
+		self.element = Gst.ElementFactory.make("spectrum", "spectrum")
+		self.element.set_property("bands", Analyzer.BANDS)
+		self.element.set_property("threshold", Analyzer.THRESHOLD)
+		self.element.set_property("interval", Gst.SECOND // self.cavaconfig["general"]["framerate"])
+		self.element.set_property("post-messages", True)
+		self.element.set_property("message-magnitude", True)
+
+		self.playbin.set_property("audio-filter", self.element)
+		self.playbin.get_bus().set_sync_handler(self._on_sync_message)
+
+	def _setup_mailbox(self):
+		bars = self.cavaconfig["general"]["bars"]
+		self.mailbox.setup(lambda: array.array("d", bytes(8 * bars)))
+
+	def _get_mapper(self):
+		"""Get bar mapper suitable for current stream sample rate"""
+		caps = self.element.get_static_pad("sink").get_current_caps()
+		is_ok, rate = caps.get_structure(0).get_int("rate") if caps is not None else (False, None)
+		if not is_ok:
+			return None
+
+		mapper = self.mapper
+		if mapper is None or rate != self.rate:
+			mapper = self.mapper = BarMapper(self.cavaconfig, Analyzer.BANDS, rate, Analyzer.THRESHOLD)
+			self.rate = rate
+		return mapper
+
+	def _on_sync_message(self, bus, message):
+		"""Turn spectrum element messages into frames stamped with pipeline clock time"""
+		if message.type == Gst.MessageType.ELEMENT and message.src == self.element:
+			structure = message.get_structure()
+			match = MAGNITUDE_PATTERN.search(structure.to_string())
+			mapper = self._get_mapper()
+			if match and mapper is not None:
+				_, running_time = structure.get_uint64("running-time")
+				_, duration = structure.get_uint64("duration")
+
+				sample = array.array("d", bytes(8 * mapper.bars))
+				mapper.process([float(value) for value in match.group(1).split(",")], sample)
+				self.frames.append((self.playbin.get_base_time() + running_time + duration // 2, sample))
+				if not self.is_scheduling:
+					self.is_scheduling = True
+					GLib.idle_add(self._on_frame)
+			return Gst.BusSyncReply.DROP
+		return Gst.BusSyncReply.PASS
+
+	def _clock_time(self):
+		clock = self.playbin.get_clock()
+		return clock.get_time() if clock is not None else None
+
+	def _on_frame(self):
+		self.is_scheduling = False  # reset before frames check, so frame appended meanwhile is not missed
+		return self._schedule()
+
+	def _schedule(self):
+		"""Wait for the pipeline clock time of the next frame"""
+		if self.timer is None and self.frames:
+			now = self._clock_time()
+			delay = max(self.frames[0][0] - now, 0) // Gst.MSECOND if now is not None else 0
+			self.timer = GLib.timeout_add(delay, self._step)
+		return False
+
+	def _step(self):
+		self.timer = None
+		now = self._clock_time()
+		sample = None
+		while self.frames and (now is None or self.frames[0][0] <= now + Gst.MSECOND):
+			sample = self.frames.popleft()[1]
+
+		# frames go through mailbox in any mode, so they are dispatched and timed like other sources ones
+		if sample is not None:
+			if len(self.mailbox.back) != len(sample):
+				self._setup_mailbox()
+			self.mailbox.back[:] = sample
+			self._publish(GLib.get_monotonic_time())
+
+		self._schedule()
+		return False
+
+	def clear(self):
+		"""Drop all pending frames"""
+		self.frames.clear()
+		if self.timer is not None:
+			GLib.source_remove(self.timer)
+			self.timer = None
+
+	def reset(self):
+		"""Apply new spectrum settings"""
+		self.clear()
+		self.mapper = None
+		self._setup_mailbox()
+
+	def activate(self, is_active):
+		"""Switch visualizer between player spectrum and external spectrum source"""
+		backend = self._mainapp.cava
+		self.is_active = is_active
+		if is_active:
+			backend.pause()
+		else:
+			self.clear()
+			backend.resume()
+
+		if self.vsync:
+			self._mainapp.draw.set_source(self.mailbox if is_active else backend.mailbox)
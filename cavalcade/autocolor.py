@@ -1,12 +1,15 @@
 # -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
 import io
+import os
+import hashlib
+import signal
 import multiprocessing
 import colorsys
 
 from gi.repository import GLib, Gdk
 from cavalcade.common import AttributeDict
-from operator import add
-from PIL import Image
+from cavalcade.adata import ColorCache
+from PIL import Image, ImageChops, ImageStat
 from cavalcade.logger import logger
 
 
@@ -15,26 +18,23 @@ def bytes_to_file(bytes_):
 
 
 class Cluster:
-	"""Group of color points"""
+	"""Group of color points, only total mass and weighted color sum are kept"""
 
-	# noinspection PyDefaultArgument
-	def __init__(self, points = []):
-		self.points = []
-		self.mass = 0
+	def __init__(self, points=(), mass=0, color=(0.0, 0.0, 0.0)):
+		self.mass = mass
+		self.color = list(color)
 		for p in points:
 			self.add(p)
 
 	def add(self, point):
 		"""Add new point to group"""
-		self.points.append(point)
 		self.mass += point.count
+		for i, c in enumerate(point.rgb):
+			self.color[i] += c * point.count
 
 	def get_color(self):
 		"""Calculate average color for group"""
-		color = [0.0] * 3
-		for point in self.points:
-			color = map(add, color, [c * point.count for c in point.rgb])
-		return [(c / max(self.mass, 1)) for c in color]
+		return [(c / max(self.mass, 1)) for c in self.color]
 
 
 def get_points(img, limit):
@@ -49,35 +49,229 @@ def get_points(img, limit):
 	return points
 
 
+def window_sums(values, window):
+	"""Sums of every group of consecutive values, last groups are continued from the list start"""
+	n = len(values)
+	extended = values + values[:window - 1]
+	total = sum(extended[:window])
+	sums = [total]
+	for i in range(1, n):
+		total -= extended[i - 1]
+		if i + window - 1 < len(extended):
+			total += extended[i + window - 1]
+		sums.append(total)
+	return sums
+
+
 def allocate(points, n=16, window=4):
 	"""Split points to groups according there color"""
 	band = 1 / n
-	clusters = [Cluster() for _ in range(n)]
+	mass = [0] * n
+	color = [[0.0] * n for _ in range(3)]
 	for point in points:
-		i = int(point.hsv[0] // band)
-		clusters[i].add(point)
-	clusters_l = clusters + clusters[:window - 1]
-	bands = [clusters_l[i:i + window] for i in range(n)]
-	rebanded = [Cluster(sum([c.points for c in band], [])) for band in bands]
+		i = int(point["hsv"][0] // band)
+		count = point["count"]
+		r, g, b = point["rgb"]
+		mass[i] += count
+		color[0][i] += r * count
+		color[1][i] += g * count
+		color[2][i] += b * count
+
+	# every group unites several neighbour bands
+	masses = window_sums(mass, window)
+	colors = zip(*(window_sums(c, window) for c in color))
+	rebanded = [Cluster(mass=m, color=c) for m, c in zip(masses, colors)]
 	return rebanded
 
 
+def points_color(img, options):
+	"""Find the main color of image, reference implementation working with color points"""
+	points = get_points(img, options)
+	clusters = allocate(points, options["bands"], options["window"])
+	selected = max(clusters, key=lambda x: x.mass)
+	return selected.get_color()
+
+
+def numpy_color(img, options):
+	"""
+	Find the main color of image, vectorized implementation.
+	Gives the same result as reference one.
+	"""
+	import numpy
+
+	n, window = options["bands"], options["window"]
+	pixels = numpy.asarray(img.convert("RGB")).reshape(-1, 3)
+	r, g, b = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+
+	# colorless and dark points are dropped before any float calculation
+	maxc = numpy.maximum(numpy.maximum(r, g), b)
+	minc = numpy.minimum(numpy.minimum(r, g), b)
+	keep = (maxc > minc) & (maxc >= options["value_min"] * 255)
+	r, g, b, maxc, minc = (c[keep] / 255 for c in (r, g, b, maxc, minc))
+
+	# rgb to hsv conversion exactly as colorsys does
+	rangec = maxc - minc
+	keep = (maxc > options["value_min"]) & (rangec / maxc > options["saturation_min"])
+	r, g, b, maxc, rangec = (c[keep] for c in (r, g, b, maxc, rangec))
+
+	rc, gc, bc = (maxc - r) / rangec, (maxc - g) / rangec, (maxc - b) / rangec
+	hue = numpy.where(r == maxc, bc - gc, numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+	hue = (hue / 6.0) % 1.0
+
+	# hue bands histogram
+	index = numpy.minimum((hue // (1 / n)).astype(numpy.intp), n - 1)
+	mass = numpy.bincount(index, minlength=n)
+	color = numpy.stack([numpy.bincount(index, weights=c, minlength=n) for c in (r, g, b)], axis=1)
+
+	# windowed bands sums
+	extended_mass = numpy.concatenate((mass, mass[:window - 1]))
+	mass_sums = numpy.zeros(len(extended_mass) + 1, dtype=mass.dtype)
+	mass_sums[1:] = numpy.cumsum(extended_mass)
+	end = numpy.minimum(numpy.arange(n) + window, len(extended_mass))
+	rebanded_mass = mass_sums[end] - mass_sums[:n]
+
+	selected = int(numpy.argmax(rebanded_mass))
+	selected_color = numpy.concatenate((color, color[:window - 1]))[selected:end[selected]].sum(axis=0)
+	return [float(c) / max(int(rebanded_mass[selected]), 1) for c in selected_color]
+
+
+def pillow_color(img, options):
+	"""
+	Find the main color of image using Pillow HSV conversion and histograms only.
+	Result is approximate, because Pillow keeps hue, saturation and value as bytes.
+	"""
+	n, window = options["bands"], options["window"]
+	rgb = img.convert("RGB")
+	hue, saturation, value = rgb.convert("HSV").split()
+
+	# colorful points mask
+	saturation_min, value_min = options["saturation_min"] * 255, options["value_min"] * 255
+	mask = ImageChops.multiply(
+		saturation.point(lambda x: 255 if x > saturation_min else 0),
+		value.point(lambda x: 255 if x > value_min else 0),
+	)
+
+	# hue bands histogram
+	band_index = [h * n // 256 for h in range(256)]
+	mass = [0] * n
+	for h, count in enumerate(hue.histogram(mask)):
+		mass[band_index[h]] += count
+
+	rebanded_mass = window_sums(mass, window)
+	selected = max(range(n), key=lambda i: rebanded_mass[i])
+	if rebanded_mass[selected] == 0:
+		return [0.0] * 3
+
+	# average color for selected bands group
+	hue_mask = hue.point([255 if (band_index[h] - selected) % n < window else 0 for h in range(256)])
+	stat = ImageStat.Stat(rgb, ImageChops.multiply(mask, hue_mask))
+	return [c / 255 for c in stat.mean]
+
+
+ENGINES = dict(points=points_color, numpy=numpy_color, pillow=pillow_color)
+
+
+def image_key(source, options):
+	"""Cache key for image file or bytedata with given analyzer options"""
+	if isinstance(source, bytes):
+		digest = hashlib.sha1(source).hexdigest()
+	else:
+		try:
+			with open(source, "rb") as fp:
+				digest = hashlib.sha1(fp.read()).hexdigest()
+		except OSError:
+			return None
+
+	options_key = tuple(
+		tuple(value) if isinstance(value, list) else value for _, value in sorted(options.items())
+	)
+	return digest, options_key
+
+
+def worker(conn, profile=None):
+	"""Main loop of persistent image analyzer process"""
+	profiler = None
+	if profile is not None:
+		from cavalcade.profiler import SamplingProfiler
+		profiler = SamplingProfiler(profile)
+		signal.signal(signal.SIGUSR1, lambda *args: profiler.save())
+		profiler.start()
+
+	while True:
+		job = conn.recv()
+		if job is None:
+			break
+
+		job_id, source, options = job
+		try:
+			color = AutoColor.calculate(source, options)
+		except Exception:
+			logger.exception("Autocolor calculation error")
+			color = None
+		conn.send((job_id, color))
+
+	if profiler is not None:
+		profiler.stop()
+
+
 class AutoColor:
 	"""Image color analyzer"""
 	def __init__(self, mainapp):
 		super().__init__()
 		self._mainapp = mainapp
 		self.config = mainapp.config
-		self.process = None
 
-		self.pc, self.cc = multiprocessing.Pipe()  # fix this
+		self.engine = self.config["autocolor"]["engine"]
+		if self.engine == "auto":
+			# approximate pillow engine is never chosen automatically
+			self.engine = "numpy" if mainapp.imported.numpy else "points"
+		logger.debug("Autocolor engine: %s", self.engine)
+
+		# worker process writes its own profile when main process is profiled
+		self.profile = mainapp.profiler.path + ".autocolor" if mainapp.profiler is not None else None
+
+		# long-lived worker process with at most one job in progress and one pending
+		self.process = None
+		self.pc = None
 		self.watcher = None
+		self.job_counter = 0
+		self.job_id = 0  # the latest job which result should be shown
+		self.is_busy = False
+		self.pending = None
+		self.job_keys = {}
+		self._start_worker()
+
+		# calculated colors cache
+		self.cache = ColorCache(mainapp)
 
 		self._mainapp.connect("tag-image-update", self.on_tag_image_update)
 		self._mainapp.connect("default-image-update", self.on_default_image_update)
 		self._mainapp.connect("image-source-switch", self.on_image_source_switch)
 		self._mainapp.connect("autocolor-refresh", self.on_image_source_switch)
 
+	def _start_worker(self):
+		"""Launch analyzer process"""
+		self.pc, cc = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=worker, args=(cc, self.profile), daemon=True)
+		self.process.start()
+		self.watcher = GLib.io_add_watch(self.pc, GLib.IO_IN | GLib.IO_HUP, self.color_setup)
+		self.is_busy = False
+		logger.debug("Autocolor worker process started")
+
+	def _send(self, job):
+		"""Send job to analyzer process"""
+		if self.process is None or not self.process.is_alive():
+			logger.warning("Autocolor worker is not running, restarting...")
+			self._start_worker()
+		self.pc.send(job)
+		self.is_busy = True
+
+	def _drop_pending(self):
+		"""Forget waiting job"""
+		if self.pending is not None:
+			self.job_keys.pop(self.pending[0], None)
+			self.pending = None
+
 	# noinspection PyUnusedLocal
 	def on_tag_image_update(self, sender, bytedata):
 		"""New image from mp3 tag"""
@@ -88,18 +282,16 @@ class AutoColor:
 				rgba = Gdk.RGBA(*saved_color, self.config["color"]["autofg"].alpha)
 				self._mainapp.emit("ac-update", rgba)
 			else:
-				file_ = bytes_to_file(bytedata)
-				# noinspection PyTypeChecker
-				self.color_update(file_)
+				self.color_update(bytedata)
 
 	# noinspection PyUnusedLocal
 	def on_image_source_switch(self, sender, usetag):
 		"""Update color from mp3 tag"""
 		if usetag:
-			file_ = bytes_to_file(self._mainapp.canvas.tag_image_bytedata)
+			source = self._mainapp.canvas.tag_image_bytedata
 		else:
-			file_ = self.config["image"]["default"]
-		self.color_update(file_)
+			source = self.config["image"]["default"]
+		self.color_update(source)
 
 	# noinspection PyUnusedLocal
 	def on_default_image_update(self, sender, file_):
@@ -108,37 +300,96 @@ class AutoColor:
 			self.color_update(file_)
 
 	@staticmethod
-	def calculate(file_, options, conn):
+	def calculate(source, options):
 		"""Find the main color of image"""
-		img = Image.open(file_)
+		img = Image.open(bytes_to_file(source) if isinstance(source, bytes) else source)
 		img.thumbnail((options["isize"][0], options["isize"][1]))
-
-		points = get_points(img, options)
-		clusters = allocate(points, options["bands"], options["window"])
-		selected = max(clusters, key=lambda x: x.mass)
-		conn.send(selected.get_color())
+		return ENGINES[options["engine"]](img, options)
 
 	def color_setup(self, conn, flag):
 		"""Read data from resent calculation and transform it to rgba color"""
 		if flag == GLib.IO_IN:
-			color_values = conn.recv()
-			rgba = Gdk.RGBA(*color_values, self.config["color"]["autofg"].alpha)
-			self._mainapp.emit("ac-update", rgba)
+			job_id, color_values = conn.recv()
+			key = self.job_keys.pop(job_id, None)
+			if key is not None and color_values is not None:
+				self.cache.add_color(key, color_values)
+
+			self.is_busy = False
+			if self.pending is not None:
+				self._send(self.pending)
+				self.pending = None
+
+			if job_id != self.job_id:
+				logger.debug("Autocolor result for outdated job %d dropped", job_id)
+			elif color_values is not None:
+				rgba = Gdk.RGBA(*color_values, self.config["color"]["autofg"].alpha)
+				self._mainapp.emit("ac-update", rgba)
 			return True
 		else:
 			logger.error("Autocolor multiprocessing error: connection was unexpectedly terminated")
+			if conn is self.pc:  # worker could be restarted already, don't touch the new one
+				self.process = None
+				self.watcher = None
+				self.is_busy = False
+				self._drop_pending()
+				self.job_keys.clear()  # results of jobs sent to dead worker will never come
+			return False
 
-	def color_update(self, file_):
-		"""Launch new calculation process with given image bytedata"""
-		if file_ is None or isinstance(file_, str) and file_.endswith(".svg"):  # fix this
+	def color_update(self, source):
+		"""
+		Queue new calculation with given image file or bytedata.
+		If analyzer is busy the job waits until it is free, replacing any other waiting one.
+		"""
+		if source is None or isinstance(source, str) and source.endswith(".svg"):  # fix this
 			return
 
-		if self.process is None or not self.process.is_alive():
-			if self.watcher is None:
-				self.watcher = GLib.io_add_watch(self.pc, GLib.IO_IN | GLib.IO_HUP, self.color_setup)
-			self.process = multiprocessing.Process(
-				target=self.calculate, args=(file_, self.config["autocolor"], self.cc)
-			)
-			self.process.start()
+		self.job_counter += 1
+		self.job_id = self.job_counter
+		options = dict(self.config["autocolor"], engine=self.engine)
+
+		# check previous calculations first
+		key = image_key(source, options)
+		color_values = self.cache.find_color(key) if key is not None else None
+		if color_values is not None:
+			logger.debug("Autocolor cache hit for job %d", self.job_id)
+			self._drop_pending()
+			rgba = Gdk.RGBA(*color_values, self.config["color"]["autofg"].alpha)
+			self._mainapp.emit("ac-update", rgba)
+			return
+
+		self.job_keys[self.job_id] = key
+		job = (self.job_id, source, options)
+		if self.is_busy:
+			self._drop_pending()
+			self.pending = job
 		else:
-			logger.error("Autocolor threading error: previous process still running, refusing to start new one")
+			self._send(job)
+
+	def prefetch(self, source):
+		"""
+		Calculate color in advance to fill the cache, only if analyzer is free.
+		Result is cached but not shown.
+		"""
+		if source is None or isinstance(source, str) and source.endswith(".svg") or self.is_busy:
+			return
+
+		options = dict(self.config["autocolor"], engine=self.engine)
+		key = image_key(source, options)
+		if key is None or key in self.cache.colors:
+			return
+
+		self.job_counter += 1
+		self.job_keys[self.job_counter] = key
+		self._send((self.job_counter, source, options))
+
+	def save_profile(self):
+		"""Ask profiled worker process to save its data"""
+		if self.profile is not None and self.process is not None and self.process.is_alive():
+			os.kill(self.process.pid, signal.SIGUSR1)
+
+	def close(self):
+		"""Stop analyzer process and save calculated colors"""
+		self.cache.save()
+		if self.process is not None and self.process.is_alive():
+			self.pc.send(None)
+			self.process.join(1)
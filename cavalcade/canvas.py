@@ -1,10 +1,13 @@
 # -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
 
-from gi.repository import Gtk, Gdk, Gio, GLib
+import cairo
+
+from gi.repository import Gtk, Gdk, Gio, GLib, GdkPixbuf
 import cavalcade.pixbuf as pixbuf
 
 from cavalcade.logger import logger
 from cavalcade.common import set_actions
+from cavalcade.timing import FrameTiming
 
 
 def bool_to_srt(*values):
@@ -12,6 +15,14 @@ def bool_to_srt(*values):
 	return ";".join("1" if v else "" for v in values)
 
 
+def align_offset(area, image, to_end):
+	"""Image position inside area the same way scrolled image is shown"""
+	if image <= area:
+		return (area - image) // 2
+	else:
+		return area - image if to_end else 0
+
+
 # noinspection PyUnusedLocal
 class Canvas:
 	"""Main window manager"""
@@ -23,16 +34,33 @@ class Canvas:
 		self.default_size = self.config["misc"]["dsize"]
 		self.last_size = (-1, -1)
 		self.tag_image_bytedata = None
+		self.pixbuf = None
+		self.cache = pixbuf.PixbufCache(self.config["image"]["cache"])
+		self.loader = pixbuf.AsyncLoader(self._on_background_loaded, self.cache)
+		self._rebuild_timer = None
 		self.actions = {}
 
 		# window setup
+		# in offscreen mode background image is pre-rendered and painted by drawing widget itself
+		self.offscreen = self.config["image"]["offscreen"]
 		self.overlay = Gtk.Overlay()
 		self.image = Gtk.Image()
 		self.scrolled = Gtk.ScrolledWindow()
 		self.scrolled.add(self.image)
 
-		self.overlay.add(self.scrolled)
-		self.overlay.add_overlay(self.draw.area)
+		if self.offscreen:
+			self.overlay.add(self.draw.area)
+		else:
+			self.overlay.add(self.scrolled)
+			self.overlay.add_overlay(self.draw.area)
+
+		# frame timing statistics overlay
+		self.hud = Gtk.Label(halign=Gtk.Align.START, valign=Gtk.Align.START, margin=8)
+		self.hud.set_no_show_all(True)
+		self.overlay.add_overlay(self.hud)
+		self.overlay.set_overlay_pass_through(self.hud, True)
+		self._hud_timer = None
+		self._hud_dropped = (None, 0)  # mailbox and its dropped frames counter at last update
 
 		self.va = self.scrolled.get_vadjustment()
 		self.ha = self.scrolled.get_hadjustment()
@@ -80,7 +108,7 @@ class Canvas:
 		"""Init drawing window"""
 		self.rebuild_window()
 		# fix this
-		if not self.config["image"]["show"]:
+		if not self.config["image"]["show"] and not self.offscreen:
 			self.overlay.remove(self.scrolled)
 
 	def _launch_cursor_hide_timer(self):
@@ -116,6 +144,8 @@ class Canvas:
 		action.set_state(value)
 		state = [bool(s) for s in value.get_string().split(";")]
 		self.config["image"]["ha"], self.config["image"]["va"] = state
+		if self.offscreen:
+			self.render_background()
 
 	def _on_winstate(self, action, value):
 		action.set_state(value)
@@ -134,7 +164,9 @@ class Canvas:
 
 		if self.config["image"]["show"] != show:
 			self.config["image"]["show"] = show
-			if show:
+			if self.offscreen:
+				self.rebuild_background() if show else self.render_background()
+			elif show:
 				self.overlay.add(self.scrolled)
 				self.rebuild_background()
 			else:
@@ -188,31 +220,139 @@ class Canvas:
 		rgba = self.config["color"]["bg"] if value else Gdk.RGBA(0, 0, 0, 0)
 		self.set_bg_rgba(rgba)
 
+	def _set_hud(self, value):
+		"""Show frame timing statistics"""
+		self.config["window"]["hud"] = value
+		timing = self.draw.timing
+		timing.enabled = value
+
+		if value and self._hud_timer is None:
+			timing.period = 1000000 / self._mainapp.cavaconfig["general"]["framerate"]
+			timing.reset()
+			mailbox = self._hud_mailbox()
+			self._hud_dropped = (mailbox, mailbox.dropped)
+			self._hud_timer = GLib.timeout_add_seconds(1, self._update_hud)
+		elif not value and self._hud_timer is not None:
+			GLib.source_remove(self._hud_timer)
+			self._hud_timer = None
+
+		self.hud.set_visible(value)
+
+	def _hud_mailbox(self):
+		"""Frames mailbox of currently active spectrum source"""
+		spectrum = self._mainapp.player.spectrum if hasattr(self._mainapp, "player") else None
+		return spectrum.mailbox if spectrum is not None and spectrum.is_active else self._mainapp.cava.mailbox
+
+	def _update_hud(self):
+		data = self.draw.timing.summary()
+		mailbox = self._hud_mailbox()
+		last_mailbox, last_dropped = self._hud_dropped
+		dropped = mailbox.dropped - last_dropped if mailbox is last_mailbox else 0  # source was switched
+		lines = ["fps %6.1f   late %3d   dropped %3d" % (data["fps"], data["late"], dropped)]
+		self._hud_dropped = (mailbox, mailbox.dropped)
+
+		for stage in FrameTiming.STAGES:
+			p50, p99, _ = data["stages"][stage]
+			lines.append("%-8s p50 %6.2f ms   p99 %6.2f ms" % (stage, p50 / 1000, p99 / 1000))
+
+		self.hud.set_markup(
+			'<span font_family="monospace" foreground="white" background="#00000099">%s</span>' % "\n".join(lines)
+		)
+		return True
+
 	def _screen_size(self):
 		"""Get current screen size"""
 		return self.screen.get_width(), self.screen.get_height()
 
+	def background_size(self):
+		"""Size for background image scaling"""
+		return self._screen_size() if self.config["window"]["imagebyscreen"] else self.last_size
+
 	def rebuild_background(self):
-		"""Update background according current state"""
-		size = self._screen_size() if self.config["window"]["imagebyscreen"] else self.last_size
+		"""
+		Update background according current state.
+		Image is loaded asynchronously, old background is shown until new one is ready.
+		"""
+		size = self.background_size()
 		if not self.config["image"]["usetag"] or self.tag_image_bytedata is None:
-			pb = pixbuf.from_file_at_scale(self.config["image"]["default"], *size)
+			self.loader.from_file_at_scale(self.config["image"]["default"], *size)
+		else:
+			self.loader.from_bytes_at_scale(self.tag_image_bytedata, *size)
+
+	def _on_background_loaded(self, pb):
+		"""Set new background image"""
+		self.pixbuf = pb
+		self._show_background(pb)
+
+	def _show_background(self, pb):
+		if self.offscreen:
+			self.render_background(pb)
 		else:
-			pb = pixbuf.from_bytes_at_scale(self.tag_image_bytedata, *size)
-		self.image.set_from_pixbuf(pb)
+			self.image.set_from_pixbuf(pb)
+
+	def _show_draft_background(self):
+		"""Fast low quality rescale of current background to fit window size"""
+		width, height = self.last_size
+		pw, ph = self.pixbuf.get_width(), self.pixbuf.get_height()
+		scale = min(width / pw, height / ph)
+		draft = self.pixbuf.scale_simple(
+			max(int(pw * scale), 1), max(int(ph * scale), 1), GdkPixbuf.InterpType.NEAREST
+		)
+		self._show_background(draft)
+
+	def _schedule_rebuild(self):
+		"""Rebuild background when window size has been stable for a while"""
+		if self._rebuild_timer is not None:
+			GLib.source_remove(self._rebuild_timer)
+		self._rebuild_timer = GLib.timeout_add(self.config["image"]["rebuild_delay"], self._on_rebuild_timer)
+
+	def _on_rebuild_timer(self):
+		self._rebuild_timer = None
+		self.rebuild_background()
+		return False
+
+	def render_background(self, pb=None):
+		"""Pre-render scaled and aligned background image for offscreen mode"""
+		if pb is None:
+			pb = self.pixbuf
+
+		if pb is None or not self.config["image"]["show"]:
+			self.draw.set_background(None)
+			return
+
+		width, height = self.last_size
+		if width <= 0 or height <= 0:
+			return  # window not allocated yet, will be rendered on size update
+
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+		cr = cairo.Context(surface)
+		x = align_offset(width, pb.get_width(), self.config["image"]["ha"])
+		y = align_offset(height, pb.get_height(), self.config["image"]["va"])
+		Gdk.cairo_set_source_pixbuf(cr, pb, x, y)
+		cr.paint()
+
+		self.draw.set_background(surface)
 
 	# noinspection PyUnusedLocal
 	def _on_size_update(self, *args):
-		"""Update window state on size changes"""
+		"""
+		Update window state on size changes.
+		Background rebuild is delayed until resizing is over, draft image is shown meanwhile.
+		"""
 		size = self.window.get_size()
 		if self.last_size != size:
 			self.last_size = size
 			if self.config["image"]["show"]:
-				if self.config["window"]["imagebyscreen"]:
+				if self.config["window"]["imagebyscreen"] and self.offscreen:
+					self.render_background()
+				elif self.config["window"]["imagebyscreen"]:
 					self.va.set_value(self.screen.get_height() if self.config["image"]["va"] else 0)
 					self.ha.set_value(self.screen.get_width() if self.config["image"]["ha"] else 0)
-				else:
+				elif self.pixbuf is None:
 					self.rebuild_background()
+				else:
+					self._show_draft_background()
+					self._schedule_rebuild()
 
 	def set_bg_rgba(self, rgba):
 		"""Set window background color"""
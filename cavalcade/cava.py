@@ -1,7 +1,8 @@
 # -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
 
 import os
-import struct
+import array
+import signal
 import threading
 import subprocess
 
@@ -9,7 +10,140 @@ from gi.repository import GLib
 from cavalcade.logger import logger
 
 
-class Cava:
+class FrameDecoder:
+	"""
+	Raw cava output decoder.
+	Frame bytes are read into one preallocated buffer and normalized in place,
+	so steady state reading does not allocate new objects per frame.
+	"""
+	def __init__(self, bars, is_16bit, use_numpy=False):
+		self.bars = bars
+		byte_type, byte_size, self.byte_norm = ("H", 2, 65535) if is_16bit else ("B", 1, 255)
+		self.chunk = byte_size * bars  # number of bytes for given format
+
+		self.buffer = bytearray(self.chunk)
+		self.view = memoryview(self.buffer)
+
+		if use_numpy:
+			import numpy
+			self.numpy = numpy
+			self.raw = numpy.frombuffer(self.buffer, dtype=numpy.uint16 if is_16bit else numpy.uint8)
+			self.normalize = self._normalize_numpy
+		else:
+			self.numpy = None
+			self.raw = self.view.cast(byte_type)
+			self.normalize = self._normalize_array
+
+	def new_sample(self):
+		"""Create empty sample storage suitable for this decoder"""
+		if self.numpy is not None:
+			return self.numpy.zeros(self.bars)
+		else:
+			return array.array("d", bytes(8 * self.bars))
+
+	def read(self, fifo):
+		"""Read next raw frame from stream, return False on stream end"""
+		return fifo.readinto(self.view) == self.chunk
+
+	def _normalize_numpy(self, sample):
+		self.numpy.divide(self.raw, self.byte_norm, out=sample)
+
+	def _normalize_array(self, sample):
+		norm = self.byte_norm
+		for i, value in enumerate(self.raw):
+			sample[i] = value / norm
+
+
+class FrameMailbox:
+	"""
+	Latest frame wins exchange between reader thread and GTK main loop.
+	Three preallocated samples are rotated: writer fills the back one and publishes it,
+	consumer takes the freshest published one, frames not taken in time are overwritten.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._back = self._ready = self._front = None
+		self._ready_time = 0
+		self._fresh = False
+		self.time = 0  # monotonic time of the last taken frame, microseconds
+
+		self.produced = 0
+		self.consumed = 0
+		self.dropped = 0
+
+	def setup(self, factory):
+		"""Allocate sample storage"""
+		with self._lock:
+			self._back, self._ready, self._front = factory(), factory(), factory()
+			self._fresh = False
+
+	@property
+	def back(self):
+		"""Sample storage for the next frame"""
+		return self._back
+
+	def post(self, stamp=0):
+		"""Publish the back sample, return True if consumer has no pending wake up"""
+		with self._lock:
+			self._back, self._ready = self._ready, self._back
+			self._ready_time = stamp
+			self.produced += 1
+			if self._fresh:
+				self.dropped += 1
+				return False
+			self._fresh = True
+			return True
+
+	def take(self):
+		"""Get the freshest sample or None if nothing new was published"""
+		with self._lock:
+			if not self._fresh:
+				return None
+			self._front, self._ready = self._ready, self._front
+			self.time = self._ready_time
+			self._fresh = False
+			self.consumed += 1
+			return self._front
+
+	def log_stats(self):
+		"""Show frame counters"""
+		logger.debug(
+			"Frames produced: %d, consumed: %d, dropped: %d", self.produced, self.consumed, self.dropped
+		)
+
+
+class SpectrumSource:
+	"""
+	Base for spectrum providers.
+	Frames are published through mailbox and delivered to drawing widget by idle dispatch,
+	or pulled by widget itself on every display refresh in vsync mode.
+	"""
+	def __init__(self, mainapp, attach=True):
+		self.data_handler = mainapp.draw.update
+		self.mailbox = FrameMailbox()
+		self.timing = mainapp.draw.timing
+
+		# let drawing widget pull frames by itself on every display refresh
+		self.vsync = mainapp.config["misc"]["vsync"]
+		if self.vsync and attach:
+			mainapp.draw.set_source(self.mailbox)
+
+	def _publish(self, stamp):
+		"""Post filled back sample of mailbox, wake up main loop if needed"""
+		if self.mailbox.post(stamp) and not self.vsync:
+			GLib.idle_add(self._dispatch)
+
+	def _dispatch(self):
+		"""Send the freshest frame to drawing handler"""
+		sample = self.mailbox.take()
+		if sample is not None:
+			if self.timing.enabled:
+				self.timing.dispatched(self.mailbox.time)
+			self.data_handler(sample)
+		return False
+
+
+class Cava(SpectrumSource):
 	"""
 	CAVA wrapper.
 	Launch cava process with certain settings and read output.
@@ -18,19 +152,19 @@ class Cava:
 	RUNNING = 1
 	RESTARTING = 2
 	CLOSING = 3
+	SUSPENDED = 4
 
 	def __init__(self, mainapp):
+		super().__init__(mainapp)
 		self.cavaconfig = mainapp.cavaconfig
 		self.path = self.cavaconfig["output"]["raw_target"]
-		self.data_handler = mainapp.draw.update
 		self.command = ["cava", "-p", self.cavaconfig.file]
 		self.state = self.NONE
+		self.is_paused = False
 
 		self.env = dict(os.environ)
 		self.env["LC_ALL"] = "en_US.UTF-8"  # not sure if it's necessary
-
-		is_16bit = self.cavaconfig["output"]["bit_format"] == "16bit"
-		self.byte_type, self.byte_size, self.byte_norm = ("H", 2, 65535) if is_16bit else ("B", 1, 255)
+		self.use_numpy = mainapp.imported.numpy
 
 		if not os.path.exists(self.path):
 			os.mkfifo(self.path)
@@ -43,36 +177,44 @@ class Cava:
 			)
 			logger.debug("cava successfully launched!")
 			self.state = self.RUNNING
+			if self.is_paused:
+				self.pause()
 		except Exception:
 			logger.exception("Fail to launch cava")
 
 	def _start_reader_thread(self):
 		logger.debug("Activate cava stream handler")
-		self.thread = threading.Thread(target=self._read_output)
+		self.thread = threading.Thread(target=self._read_output, name="cava-reader")
 		self.thread.daemon = True
 		self.thread.start()
 
 	def _read_output(self):
 		fifo = open(self.path, "rb")
-		chunk = self.byte_size * self.cavaconfig["general"]["bars"]  # number of bytes for given format
-		fmt = self.byte_type * self.cavaconfig["general"]["bars"]  # pack of given format
-		while True:
-			data = fifo.read(chunk)
-			if len(data) < chunk:
-				break
-			sample = [i / self.byte_norm for i in struct.unpack(fmt, data)]
-			GLib.idle_add(self.data_handler, sample)
+		is_16bit = self.cavaconfig["output"]["bit_format"] == "16bit"
+		decoder = FrameDecoder(self.cavaconfig["general"]["bars"], is_16bit, self.use_numpy)
+		self.mailbox.setup(decoder.new_sample)
+		timing = self.timing
+		started = GLib.get_monotonic_time()
+		while decoder.read(fifo):
+			stamp = GLib.get_monotonic_time()
+			decoder.normalize(self.mailbox.back)
+			if timing.enabled:
+				timing.add("wait", stamp - started)
+				timing.add("decode", GLib.get_monotonic_time() - stamp)
+			self._publish(stamp)
+			started = GLib.get_monotonic_time()
 		fifo.close()
 		GLib.idle_add(self._on_stop)
 
 	def _on_stop(self, ):
 		logger.debug("Cava stream handler deactivated")
+		self.mailbox.log_stats()
 		if self.state == self.RESTARTING:
 			if not self.thread.isAlive():
 				self.start()
 			else:
 				logger.error("Can't restart cava, old handler still alive")
-		elif self.state == self.RUNNING:
+		elif self.state in (self.RUNNING, self.SUSPENDED):
 			self.state = self.NONE
 			logger.error("Cava process was unexpectedly terminated.")
 			# self.restart()  # May cause infinity loop, need more check
@@ -82,9 +224,25 @@ class Cava:
 		self._start_reader_thread()
 		self._run_process()
 
+	def pause(self):
+		"""Suspend cava process while spectrum is provided by another source"""
+		self.is_paused = True
+		if self.state == self.RUNNING:
+			logger.debug("Suspending cava process")
+			self.process.send_signal(signal.SIGSTOP)
+			self.state = self.SUSPENDED
+
+	def resume(self):
+		"""Continue suspended cava process"""
+		self.is_paused = False
+		if self.state == self.SUSPENDED:
+			logger.debug("Resuming cava process")
+			self.process.send_signal(signal.SIGCONT)
+			self.state = self.RUNNING
+
 	def restart(self):
 		"""Restart cava process"""
-		if self.state == self.RUNNING:
+		if self.state in (self.RUNNING, self.SUSPENDED):
 			logger.debug("Restarting cava process (normal mode) ...")
 			self.state = self.RESTARTING
 			if self.process.poll() is None:
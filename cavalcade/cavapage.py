@@ -91,6 +91,8 @@ class CavaPage(GuiBase):
 		# update settings with current data
 		self._mainapp.cavaconfig.write_data()
 		self._mainapp.cava.restart()
+		if hasattr(self._mainapp, "player") and self._mainapp.player.spectrum is not None:
+			self._mainapp.player.spectrum.reset()
 		self._mainapp.draw.size_update()
 
 	# noinspection PyUnusedLocal
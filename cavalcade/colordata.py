@@ -1,6 +1,7 @@
 # -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
 from gi.repository import Gtk, Pango, GdkPixbuf
 from cavalcade.common import GuiBase, TreeViewHolder, AttributeDict
+from cavalcade.search import SearchIndex
 
 # TODO: make color list update on every new color added?
 
@@ -14,7 +15,8 @@ class ColorsWindow(GuiBase):
 		super().__init__("colors.glade", elements=elements)
 
 		self._mainapp = mainapp
-		self.search_text = None
+		self.search = SearchIndex()
+		self.found = None
 
 		# some gui constants
 		self.COLOR_STORE = AttributeDict(INDEX=0, FILE=1, COLOR=2, ICON=3)
@@ -38,7 +40,6 @@ class ColorsWindow(GuiBase):
 		self.store = Gtk.ListStore(int, str, str, GdkPixbuf.Pixbuf)
 		self.store_filter = self.store.filter_new()
 		self.store_filter.set_visible_func(self.colors_filter_func)
-		self.search_text = None
 
 		self.treeview.set_model(self.store_filter)
 
@@ -49,7 +50,7 @@ class ColorsWindow(GuiBase):
 
 		# signals
 		self.gui["window"].connect("delete-event", self.hide)
-		self.gui["colors-searchentry"].connect("activate", self.on_search_active)
+		self.gui["colors-searchentry"].connect("search-changed", self.on_search_active)
 		self.gui["colors-searchentry"].connect("icon-release", self.on_search_reset)
 		self.gui["color-delete-button"].connect("clicked", self.on_color_delete_button_click)
 
@@ -57,6 +58,7 @@ class ColorsWindow(GuiBase):
 		"""Update colors store"""
 		with self.treelock:
 			self.store.clear()
+			self.search.clear()
 
 			for i, (file_, color) in enumerate(data.items()):
 				pixbuf = GdkPixbuf.Pixbuf.new(
@@ -65,25 +67,28 @@ class ColorsWindow(GuiBase):
 				)
 				pixbuf.fill(int("%02X%02X%02XFF" % tuple(int(i*255) for i in color), 16))  # fix this
 				self.store.append([i, file_, "%.2f %.2f %.2f" % color, pixbuf])
+				self.search.add(file_, file_)
+			self.filter_by_search()
 
 	# noinspection PyUnusedLocal
 	def colors_filter_func(self, model, treeiter, data):
 		"""Function to filter current color list by search text"""
-		if not self.search_text:
-			return True
-		else:
-			return self.search_text.lower() in model[treeiter][self.COLOR_STORE.FILE].lower()
+		return self.found is None or model[treeiter][self.COLOR_STORE.FILE] in self.found
+
+	def filter_by_search(self):
+		"""Filter color list by search text"""
+		text = self.gui["colors-searchentry"].get_text()
+		self.found = self.search.search(text) if text else None
+		self.store_filter.refilter()
 
 	# GUI handlers
 	# noinspection PyUnusedLocal
 	def on_search_active(self, *args):
-		self.search_text = self.gui["colors-searchentry"].get_text()
-		self.store_filter.refilter()
+		self.filter_by_search()
 
 	# noinspection PyUnusedLocal
 	def on_search_reset(self, *args):
 		self.gui["colors-searchentry"].set_text("")
-		self.on_search_active()
 
 	# noinspection PyUnusedLocal
 	def on_color_delete_button_click(self, *args):
@@ -25,6 +25,13 @@ def import_optional():
 		success.pillow = False
 		logger.warning("Fail to import Pillow module")
 
+	try:
+		import numpy  # noqa: F401
+		success.numpy = True
+	except Exception:
+		success.numpy = False
+		logger.warning("Fail to import NumPy module")
+
 	return success
 
 
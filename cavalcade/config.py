@@ -192,13 +192,17 @@ class MainConfig(ConfigBase):
 					bgpaint = AttributeDict(type=bool),
 					fullscreen = AttributeDict(type=bool),
 					skiptaskbar = AttributeDict(type=bool),
+					hud = AttributeDict(type=bool),
 				),
 				image = dict(
 					show = AttributeDict(type=bool),
 					usetag = AttributeDict(type=bool),
 					va = AttributeDict(type=bool),
 					ha = AttributeDict(type=bool),
-					default = AttributeDict(type=str)
+					default = AttributeDict(type=str),
+					offscreen = AttributeDict(type=bool),
+					cache = AttributeDict(type=int),
+					rebuild_delay = AttributeDict(type=int),
 				),
 				autocolor = dict(
 					bands = AttributeDict(type=int),
@@ -206,17 +210,26 @@ class MainConfig(ConfigBase):
 					saturation_min = AttributeDict(type=float),
 					value_min = AttributeDict(type=float),
 					isize = AttributeDict(type="ilist"),
+					engine = AttributeDict(type=str, valid=["auto", "numpy", "pillow", "points"]),
 				),
 				player = dict(
 					volume = AttributeDict(type=float),
 					shuffle = AttributeDict(type=bool),
 					showqueue = AttributeDict(type=bool),
+					prefetch = AttributeDict(type=bool),
+					lookahead = AttributeDict(type=int),
+					prefetch_budget = AttributeDict(type=int),
+					index = AttributeDict(type=bool),
+					index_budget = AttributeDict(type=int),
+					visualize = AttributeDict(type=bool),
 				),
 				misc = dict(
 					hint = AttributeDict(type="hint", valid=GTK_WINDOW_TYPE_HINTS),
 					dsize = AttributeDict(type="ilist"),
 					cursor_hide_timeout = AttributeDict(type=int),
-
+					vsync = AttributeDict(type=bool),
+					backend = AttributeDict(type=str, valid=["cava", "gstreamer"]),
+					capture_device = AttributeDict(type=str),
 				),
 				keys = dict(
 					exit = AttributeDict(type="accel", valid=accel),
@@ -0,0 +1,271 @@
+# -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+"""
+Native cover image and base text tags extraction.
+Supported containers are ID3v2 (v2.2 - v2.4), FLAC metadata blocks and Ogg Vorbis/Opus comments.
+Files are memory mapped, so only tag data is actually read from disk.
+"""
+import mmap
+import zlib
+import base64
+import struct
+
+from cavalcade.common import AttributeDict
+from cavalcade.logger import logger
+
+FRONT_COVER = 3
+ID3_FRAMES = dict(
+	image = ("APIC", "PIC"),
+	title = ("TIT2", "TT2"),
+	artist = ("TPE1", "TP1"),
+	album = ("TALB", "TAL"),
+)
+ID3_TEXT_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+VORBIS_FIELDS = dict(TITLE="title", ARTIST="artist", ALBUM="album")
+OGG_TAGS_LIMIT = 16 * 1024 * 1024  # max size of ogg comment packet
+
+
+class TagError(Exception):
+	pass
+
+
+def syncsafe(data):
+	"""Decode ID3v2 syncsafe integer"""
+	value = 0
+	for byte in data:
+		value = (value << 7) | (byte & 0x7f)
+	return value
+
+
+def unsynchronize(data):
+	"""Revert ID3v2 unsynchronisation scheme"""
+	return data.replace(b"\xff\x00", b"\xff")
+
+
+def _split_string(data, encoding):
+	"""Split ID3v2 null terminated string of given encoding from the rest of data"""
+	if encoding in (1, 2):
+		i = 0
+		while True:
+			i = data.find(b"\x00\x00", i)
+			if i < 0 or i % 2 == 0:
+				break
+			i += 1
+		return (data, b"") if i < 0 else (data[:i], data[i + 2:])
+	else:
+		head, _, tail = data.partition(b"\x00")
+		return head, tail
+
+
+def _decode_text(data):
+	encoding = data[0] if data else 0
+	if encoding >= len(ID3_TEXT_ENCODINGS):
+		raise TagError("Unknown text encoding %d" % encoding)
+	text = data[1:].decode(ID3_TEXT_ENCODINGS[encoding], errors="replace")
+	return text.split("\x00")[0].strip() or None
+
+
+def _decode_picture(data, is_v22):
+	"""Get picture type and image bytedata from ID3v2 APIC/PIC frame"""
+	encoding = data[0]
+	if is_v22:
+		rest = data[4:]  # 3 bytes image format
+	else:
+		_, rest = _split_string(data[1:], 0)  # mime type
+	ptype = rest[0]
+	_, image = _split_string(rest[1:], encoding)
+	return ptype, image
+
+
+def _id3_frames(data, version):
+	"""Iterate over ID3v2 frames, yield id, flags and frame content"""
+	if version == 2:
+		header_size, id_size = 6, 3
+	else:
+		header_size, id_size = 10, 4
+
+	i = 0
+	while i + header_size <= len(data):
+		fid = data[i:i + id_size]
+		if not fid.strip(b"\x00") or not fid.isalnum():
+			break  # padding
+		if version == 2:
+			size = int.from_bytes(data[i + 3:i + 6], "big")
+			flags = 0
+		else:
+			size = syncsafe(data[i + 4:i + 8]) if version == 4 else int.from_bytes(data[i + 4:i + 8], "big")
+			flags = int.from_bytes(data[i + 8:i + 10], "big")
+		i += header_size
+		yield fid.decode("ascii"), flags, data[i:i + size]
+		i += size
+
+
+def _decode_frame(content, flags, version):
+	"""Apply ID3v2 frame format flags to frame content"""
+	if version == 3:
+		if flags & 0x0040:
+			raise TagError("Encrypted frame")
+		if flags & 0x0080:
+			content = content[4:]  # decompressed size
+		if flags & 0x0020:
+			content = content[1:]  # group id
+		if flags & 0x0080:
+			content = zlib.decompress(content)
+	elif version == 4:
+		if flags & 0x0004:
+			raise TagError("Encrypted frame")
+		if flags & 0x0040:
+			content = content[1:]  # group id
+		if flags & 0x0001:
+			content = content[4:]  # data length indicator
+		if flags & 0x0002:
+			content = unsynchronize(content)
+		if flags & 0x0008:
+			content = zlib.decompress(content)
+	return content
+
+
+def id3_size(data):
+	"""Full size of ID3v2 tag at the beginning of data, zero if there is no tag"""
+	if len(data) < 10 or data[:3] != b"ID3":
+		return 0
+	return 10 + syncsafe(data[6:10]) + (10 if data[5] & 0x10 else 0)
+
+
+def read_id3(data, tags):
+	"""Read ID3v2 tag at the beginning of data"""
+	version, flags = data[3], data[5]
+	if version not in (2, 3, 4):
+		raise TagError("Unsupported ID3v2 version %d" % version)
+
+	body = data[10:id3_size(data)]
+	if flags & 0x80 and version < 4:
+		body = unsynchronize(body)
+	if flags & 0x40 and version > 2:
+		if version == 3:
+			body = body[4 + int.from_bytes(body[:4], "big"):]
+		else:
+			body = body[syncsafe(body[:4]):]
+
+	names = {fid: name for name, fids in ID3_FRAMES.items() for fid in fids}
+	for fid, fflags, content in _id3_frames(body, version):
+		name = names.get(fid)
+		if name is None or not content:
+			continue
+		try:
+			content = _decode_frame(content, fflags, version)
+			if name == "image":
+				ptype, image = _decode_picture(content, version == 2)
+				if image and (tags.image is None or ptype == FRONT_COVER and not tags.is_front):
+					tags.image, tags.is_front = image, ptype == FRONT_COVER
+			elif tags[name] is None:
+				tags[name] = _decode_text(content)
+		except (TagError, IndexError, zlib.error) as e:
+			logger.debug("Skip ID3v2 frame %s: %s", fid, e)
+
+
+def read_flac_picture(data, tags):
+	"""Read FLAC picture block (also used as base64 encoded vorbis comment)"""
+	ptype, mime_size = struct.unpack(">II", data[:8])
+	i = 8 + mime_size
+	desc_size = struct.unpack(">I", data[i:i + 4])[0]
+	i += 4 + desc_size + 16  # description, width, height, depth, colors
+	image_size = struct.unpack(">I", data[i:i + 4])[0]
+	image = data[i + 4:i + 4 + image_size]
+	if image and (tags.image is None or ptype == FRONT_COVER and not tags.is_front):
+		tags.image, tags.is_front = bytes(image), ptype == FRONT_COVER
+
+
+def read_vorbis_comment(data, tags):
+	"""Read vorbis comment block"""
+	vendor_size = struct.unpack("<I", data[:4])[0]
+	i = 4 + vendor_size
+	count = struct.unpack("<I", data[i:i + 4])[0]
+	i += 4
+	for _ in range(count):
+		size = struct.unpack("<I", data[i:i + 4])[0]
+		key, _, value = bytes(data[i + 4:i + 4 + size]).partition(b"=")
+		i += 4 + size
+
+		key = key.decode("ascii", errors="replace").upper()
+		if key == "METADATA_BLOCK_PICTURE":
+			read_flac_picture(base64.b64decode(value), tags)
+		elif key in VORBIS_FIELDS and tags[VORBIS_FIELDS[key]] is None:
+			tags[VORBIS_FIELDS[key]] = value.decode("utf-8", errors="replace").strip() or None
+
+
+def read_flac(data, start, tags):
+	"""Read FLAC metadata blocks"""
+	i = start + 4
+	is_last = False
+	while not is_last and i + 4 <= len(data):
+		header = data[i]
+		is_last, btype = header & 0x80, header & 0x7f
+		size = int.from_bytes(data[i + 1:i + 4], "big")
+		i += 4
+		if btype == 6:
+			read_flac_picture(data[i:i + size], tags)
+		elif btype == 4:
+			read_vorbis_comment(data[i:i + size], tags)
+		i += size
+
+
+def ogg_packets(data):
+	"""Iterate over packets of first logical stream in ogg container"""
+	i, serial, parts, length = 0, None, [], 0
+	while data[i:i + 4] == b"OggS":
+		page_serial = struct.unpack("<I", data[i + 14:i + 18])[0]
+		segments = data[i + 26]
+		lacing = data[i + 27:i + 27 + segments]
+		i += 27 + segments
+
+		if serial is None:
+			serial = page_serial
+		for size in lacing:
+			if page_serial == serial:
+				# collect segments and join them once, packet can be spread over thousands of them
+				parts.append(data[i:i + size])
+				length += size
+				if length > OGG_TAGS_LIMIT:
+					raise TagError("Ogg packet is too big")
+				if size < 255:
+					yield b"".join(parts)
+					parts, length = [], 0
+			i += size
+
+
+def read_ogg(data, tags):
+	"""Read comment header of Ogg Vorbis or Opus stream"""
+	for n, packet in enumerate(ogg_packets(data)):
+		if packet.startswith(b"\x03vorbis"):
+			read_vorbis_comment(packet[7:], tags)
+			return
+		if packet.startswith(b"OpusTags"):
+			read_vorbis_comment(packet[8:], tags)
+			return
+		if n > 1:
+			return
+
+
+def read_tags(file_):
+	"""
+	Get cover image bytedata and base text tags from audio file.
+	Return None for unsupported files, so caller could fall back to gstreamer.
+	"""
+	tags = AttributeDict(image=None, is_front=False, duration=None, title=None, artist=None, album=None)
+	try:
+		with open(file_, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			start = id3_size(data)
+			if start:
+				read_id3(data, tags)
+
+			if data[start:start + 4] == b"fLaC":
+				read_flac(data, start, tags)
+			elif data[start:start + 4] == b"OggS":
+				read_ogg(data, tags)
+			elif not start:
+				return None
+	except (OSError, ValueError, IndexError, struct.error, TagError, zlib.error) as e:
+		logger.debug("Can't read tags from %s natively: %s", file_, e)
+		return None
+
+	return tags
@@ -1,18 +1,47 @@
 # -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
-from gi.repository import Gtk, Gdk
+import copy
+import bisect
+
+from gi.repository import Gtk, Gdk, GLib
 from cavalcade.common import AttributeDict
+from cavalcade.timing import FrameTiming
+
+
+def interpolate(out, start, end, alpha):
+	"""Linear interpolation between two samples into preallocated storage"""
+	if hasattr(out, "__array_ufunc__"):  # numpy array
+		out[:] = end
+		out -= start
+		out *= alpha
+		out += start
+	else:
+		for i, (a, b) in enumerate(zip(start, end)):
+			out[i] = a + (b - a) * alpha
 
 
 class Spectrum:
-	"""Spectrum drawing"""
-	def __init__(self, config, cavaconfig):
+	"""
+	Spectrum drawing.
+	Drawing widget may be given explicitly, new Gtk.DrawingArea is created otherwise.
+	"""
+	def __init__(self, config, cavaconfig, area=None):
 		self.silence_value = 0
 		self.config = config
 		self.cavaconfig = cavaconfig
 		self.audio_sample = []
+		self.silence_sample = []
+		self.heights = []
+		self.background = None
 		self.color = None
+		self.timing = FrameTiming()
 
-		self.area = Gtk.DrawingArea()
+		# frame clock mode
+		self.source = None
+		self.frames = None
+		self.interpolated = None
+		self.is_settled = True
+
+		self.area = area if area is not None else Gtk.DrawingArea()
 		self.area.connect("draw", self.redraw)
 		self.area.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
 
@@ -21,41 +50,168 @@ class Spectrum:
 		self.sizes.bar = AttributeDict()
 
 		self.area.connect("configure-event", self.size_update)
+		self.size_update()
 		self.color_update()
 
 	def is_silence(self, value):
 		"""Check if volume level critically low during last iterations"""
 		self.silence_value = 0 if value > 0 else self.silence_value + 1
-		return self.silence_value > self.config["draw"]["silence"]
+		return self.silence_value > self.sizes.silence
 
 	def update(self, data):
-		"""Audio data processing"""
+		"""
+		Audio data processing.
+		Sample may be any sequence of normalized values (list, array or numpy array),
+		it is used as is without copying.
+		Frames of other length are left from previous bars setting and dropped.
+		"""
+		if len(data) != self.sizes.number:
+			return
+
 		self.audio_sample = data
 		if not self.is_silence(self.audio_sample[0]):
-			self.area.queue_draw()
-		elif self.silence_value == (self.config["draw"]["silence"] + 1):
-			self.audio_sample = [0] * self.sizes.number
-			self.area.queue_draw()
+			self.invalidate()
+		elif self.silence_value == (self.sizes.silence + 1):
+			self.audio_sample = self.silence_sample
+			self.invalidate()
+
+	def invalidate(self):
+		"""
+		Map current audio sample to bar heights
+		and queue redraw only for bounding box of bars whose height was changed.
+		"""
+		heights = self.heights
+		bottom, limit, zero, factor = self.sizes.bottom, self.sizes.limit, self.sizes.zero, self.sizes.factor
+		first, last, top = -1, -1, 0
+
+		for i, value in enumerate(self.audio_sample):
+			height = value * factor
+			if height > limit:
+				height = limit
+			if height < zero:
+				height = zero
+			if height != heights[i]:
+				if first < 0:
+					first = i
+				last = i
+				top = max(top, height, heights[i])
+				heights[i] = height
+
+		if first >= 0:
+			x = self.sizes.x[first]
+			y = int(bottom - top) - 1  # extra pixel for antialiasing
+			self.area.queue_draw_area(x, y, self.sizes.x[last] + self.sizes.width[last] - x, bottom - y + 1)
+
+	def set_source(self, mailbox):
+		"""
+		Pull audio data from frames mailbox once per display refresh
+		instead of waiting for every new frame.
+		"""
+		if self.source is None:
+			self.area.add_tick_callback(self._on_tick)
+		self.source = mailbox
+
+	def _push_frame(self, sample, stamp):
+		"""
+		Save new frame as the latest one for interpolation.
+		Silence is checked here once per real frame, return False if frame was skipped
+		as silent or left from previous bars setting.
+		"""
+		if len(sample) != self.sizes.number:
+			return False
+
+		is_silent = self.is_silence(sample[0])
+		if is_silent and self.silence_value != self.sizes.silence + 1:
+			if self.frames is not None and self.is_settled:
+				self.frames.te = stamp  # keep interpolation period actual for the first frame after silence
+			return False
+
+		# sources differ in sample type (numpy or plain array), storage is rebuilt when source is switched
+		if self.frames is None or type(self.frames.end) is not type(sample) or len(self.frames.end) != len(sample):
+			self.frames = AttributeDict(start=copy.copy(sample), end=copy.copy(sample), ts=stamp, te=stamp)
+			self.interpolated = copy.copy(sample)
+		else:
+			self.frames.start, self.frames.end = self.frames.end, self.frames.start
+			self.frames.end[:] = sample
+			self.frames.ts, self.frames.te = self.frames.te, stamp
+
+		if is_silent:  # silence just started, settle down to empty bars
+			end = self.frames.end
+			for i in range(len(end)):
+				end[i] = 0
+		return True
+
+	# noinspection PyUnusedLocal
+	def _on_tick(self, widget, frame_clock):
+		"""
+		Display refresh handler.
+		Picture is drawn one cava frame behind, so it can be smoothly interpolated
+		when display runs faster than cava, and intermediate frames are skipped when it runs slower.
+		"""
+		sample = self.source.take()
+		if sample is not None:
+			if self.timing.enabled:
+				self.timing.dispatched(self.source.time)
+			if self._push_frame(sample, self.source.time):
+				self.is_settled = False
+
+		if self.frames is None or self.is_settled:
+			return GLib.SOURCE_CONTINUE
+
+		period = self.frames.te - self.frames.ts
+		if period > 0:
+			alpha = min((frame_clock.get_frame_time() - self.frames.te) / period, 1)
+		else:
+			alpha = 1
+		self.is_settled = alpha >= 1
+
+		interpolate(self.interpolated, self.frames.start, self.frames.end, max(alpha, 0))
+		self.audio_sample = self.interpolated
+		self.invalidate()
+		return GLib.SOURCE_CONTINUE
+
+	def set_background(self, surface):
+		"""Set pre-rendered background image surface, None to draw spectrum only"""
+		self.background = surface
+		self.area.queue_draw()
 
 	# noinspection PyUnusedLocal
 	def redraw(self, widget, cr):
 		"""Draw spectrum graph"""
+		start = GLib.get_monotonic_time() if self.timing.enabled else None
+
+		if self.background is not None:
+			cr.set_source_surface(self.background, 0, 0)
+			cr.paint()
+
 		cr.set_source_rgba(*self.color)
 
-		dx = self.config["offset"]["left"]
-		for i, value in enumerate(self.audio_sample):
-			width = self.sizes.bar.width + int(i < self.sizes.wcpi)
-			height = max(self.sizes.bar.height * min(self.config["draw"]["scale"] * value, 1), self.sizes.zero)
-			cr.rectangle(dx, self.sizes.area.height, width, - height)
-			dx += width + self.sizes.padding
+		# only bars inside damaged area
+		left, _, right, _ = cr.clip_extents()
+		first = max(bisect.bisect_right(self.sizes.x, left) - 1, 0)
+		last = bisect.bisect_left(self.sizes.x, right)
+
+		bottom, x_, width_, heights = self.sizes.bottom, self.sizes.x, self.sizes.width, self.heights
+		for i in range(first, min(last, len(heights))):
+			cr.rectangle(x_[i], bottom, width_[i], - heights[i])
 		cr.fill()
 
+		if start is not None:
+			self.timing.drawn(start)
+
 	# noinspection PyUnusedLocal
 	def size_update(self, *args):
-		"""Update drawing geometry"""
+		"""
+		Update drawing geometry.
+		Bars position and all settings used on every frame are cached here,
+		so this should be called after any drawing settings change.
+		"""
 		self.sizes.number = self.cavaconfig["general"]["bars"]
+		if len(self.silence_sample) != self.sizes.number:
+			self.silence_sample = [0] * self.sizes.number
 		self.sizes.padding = self.config["draw"]["padding"]
 		self.sizes.zero = self.config["draw"]["zero"]
+		self.sizes.silence = self.config["draw"]["silence"]
 
 		self.sizes.area.width = self.area.get_allocated_width() - self.config["offset"]["right"]
 		self.sizes.area.height = self.area.get_allocated_height() - self.config["offset"]["bottom"]
@@ -65,6 +221,32 @@ class Spectrum:
 		self.sizes.bar.height = self.sizes.area.height - self.config["offset"]["top"]
 		self.sizes.wcpi = tw % self.sizes.number  # width correction point index
 
+		# per bar geometry
+		self.sizes.x, self.sizes.width = [], []
+		dx = self.config["offset"]["left"]
+		for i in range(self.sizes.number):
+			width = self.sizes.bar.width + int(i < self.sizes.wcpi)
+			self.sizes.x.append(dx)
+			self.sizes.width.append(width)
+			dx += width + self.sizes.padding
+
+		# value to height mapping
+		self.sizes.bottom = self.sizes.area.height
+		self.sizes.limit = self.sizes.bar.height
+		self.sizes.factor = self.sizes.bar.height * self.config["draw"]["scale"]
+
+		# restart interpolation, frames of previous size can't be mixed with new ones
+		self.frames = self.interpolated = None
+		self.is_settled = True
+
+		# remap current sample with new geometry
+		self.heights = [-1] * self.sizes.number
+		if len(self.audio_sample) != self.sizes.number:
+			self.audio_sample = self.silence_sample
+		self.invalidate()
+		self.area.queue_draw()
+
 	def color_update(self):
 		"""Set drawing color according current settings"""
 		self.color = self.config["color"]["autofg"] if self.config["color"]["auto"] else self.config["color"]["fg"]
+		self.area.queue_draw()
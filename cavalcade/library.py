@@ -0,0 +1,84 @@
+# -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+import os
+import sqlite3
+
+from cavalcade.adata import Storage
+from cavalcade.common import AttributeDict, name_from_file
+from cavalcade.logger import logger
+
+
+class MetadataIndex(Storage):
+	"""
+	Persistent audio files metadata index.
+	Records are keyed by file path and stay valid while file modification time and size are the same.
+	"""
+	FIELDS = ("title", "artist", "album", "duration", "cover")
+
+	def __init__(self, mainapp):
+		super().__init__(mainapp, "library.db")
+		self.db = sqlite3.connect(self.store)
+		self.db.execute(
+			"CREATE TABLE IF NOT EXISTS tracks ("
+			"path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, "
+			"title TEXT, artist TEXT, album TEXT, duration INTEGER, cover INTEGER)"
+		)
+
+		self.records = {}
+		for path, mtime, size, *values in self.db.execute("SELECT * FROM tracks"):
+			self.records[path] = AttributeDict(mtime=mtime, size=size, **dict(zip(self.FIELDS, values)))
+		self.changes = 0
+
+		logger.debug("Metadata index loaded, %d records", len(self.records))
+
+	def is_actual(self, path):
+		"""Check if file record exists and file was not changed since"""
+		record = self.records.get(path)
+		if record is None:
+			return False
+
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return True  # nothing to update for missing file
+		return record.mtime == stat.st_mtime_ns and record.size == stat.st_size
+
+	def add(self, path, tags):
+		"""Save file metadata"""
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return
+
+		record = AttributeDict(
+			mtime=stat.st_mtime_ns, size=stat.st_size, title=tags.title, artist=tags.artist, album=tags.album,
+			duration=tags.duration, cover=tags.image is not None,
+		)
+		self.records[path] = record
+		self.db.execute(
+			"INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+			(path, record.mtime, record.size) + tuple(record[field] for field in self.FIELDS)
+		)
+
+		self.changes += 1
+		if self.changes >= 100:
+			self.save()
+
+	def track_name(self, path):
+		"""Human readable track name from tags if available or from file name"""
+		record = self.records.get(path)
+		if record is not None and record.title:
+			return "%s - %s" % (record.artist, record.title) if record.artist else record.title
+		return name_from_file(path)
+
+	def keywords(self, path):
+		"""Text fields to search track by"""
+		record = self.records.get(path)
+		name = name_from_file(path)
+		return (self.track_name(path), record.album, name) if record is not None else (name,)
+
+	def save(self):
+		"""Write pending changes to disk"""
+		if self.changes:
+			self.db.commit()
+			logger.debug("Metadata index saved, %d records updated", self.changes)
+			self.changes = 0
@@ -28,6 +28,7 @@ class MainApp(Gtk.Application):
 
 		signal.signal(signal.SIGINT, self.gracefully_close)
 		signal.signal(signal.SIGTERM, self.gracefully_close)
+		self.profiler = None
 
 		self.add_main_option(
 			"play", ord("p"), GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
@@ -50,6 +51,10 @@ class MainApp(Gtk.Application):
 			"log-level", ord("l"), GLib.OptionFlags.NONE, GLib.OptionArg.STRING,
 			"Set log level", "LOG_LEVEL"
 		)
+		self.add_main_option(
+			"profile", 0, GLib.OptionFlags.NONE, GLib.OptionArg.STRING,
+			"Write sampling profile to file on exit or on SIGUSR1", "FILE"
+		)
 
 		self.connect("handle-local-options", self._on_handle_local_options)
 
@@ -67,6 +72,13 @@ class MainApp(Gtk.Application):
 		if options.contains("version"):
 			return 0
 
+		# optional sampling profiler, should be started before main initialization
+		if options.contains("profile") and self.profiler is None:
+			from cavalcade.profiler import SamplingProfiler
+			self.profiler = SamplingProfiler(options.lookup_value("profile").get_string())
+			self.profiler.start()
+			signal.signal(signal.SIGUSR1, self._on_profile_signal)  # save intermediate result on demand
+
 		# main app launch
 		self.activate()
 		self._parse_args(args, options)
@@ -80,6 +92,12 @@ class MainApp(Gtk.Application):
 	def do_shutdown(self):
 		if hasattr(self, "canvas"):
 			self.cava.close()
+			if hasattr(self, "autocolor"):
+				self.autocolor.close()
+			if hasattr(self, "player") and self.player.indexer is not None:
+				self.player.indexer.close()
+			if self.profiler is not None:
+				self.profiler.stop()
 			self.adata.save()
 			self.palette.save()
 
@@ -105,7 +123,7 @@ class MainApp(Gtk.Application):
 		self.adata = AudioData(self)  # audio files manager
 		self.palette = SavedColors(self)  # custom colors list
 		self.draw = Spectrum(self.config, self.cavaconfig)  # graph widget
-		self.cava = Cava(self)  # cava wrapper
+		self.cava = self._spectrum_backend()  # cava wrapper or built-in analyzer
 		self.settings = SettingsWindow(self)  # settings window
 		self.canvas = Canvas(self)  # main window
 
@@ -147,6 +165,15 @@ class MainApp(Gtk.Application):
 		self.canvas.setup()
 		self.cava.start()
 
+	def _spectrum_backend(self):
+		"""Create audio spectrum source according settings"""
+		if self.config["misc"]["backend"] == "gstreamer":
+			if self.imported.gstreamer:
+				from cavalcade.analyzer import Analyzer
+				return Analyzer(self)
+			logger.warning("Gstreamer is not available, fall back to cava backend")
+		return Cava(self)
+
 	# noinspection PyMethodMayBeStatic
 	def _on_handle_local_options(self, _, options):
 		"""GUI handler"""
@@ -176,6 +203,14 @@ class MainApp(Gtk.Application):
 		logger.info("Exit on %d signal" % signum)
 		self.quit()
 
+	# noinspection PyUnusedLocal
+	def _on_profile_signal(self, signum, frame):
+		"""Save profiling data on demand"""
+		if self.profiler is not None:
+			self.profiler.save()
+			if hasattr(self, "autocolor"):
+				self.autocolor.save_profile()
+
 	# noinspection PyUnusedLocal
 	def close(self, *args):
 		"""Application exit"""
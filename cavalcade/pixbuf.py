@@ -1,5 +1,10 @@
 # -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+import os
+import hashlib
+
+from collections import OrderedDict
 from gi.repository import Gio, GLib, GdkPixbuf
+from cavalcade.logger import logger
 
 
 def from_bytes(data):
@@ -20,3 +25,159 @@ def from_file_at_scale(file_, width, height, aspect=True):
 	"""Build Gdk pixbuf from file with scaling"""
 	pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(file_, width, height, aspect)
 	return pixbuf
+
+
+def file_key(file_):
+	"""Cache key for image file"""
+	try:
+		return file_, os.stat(file_).st_mtime_ns
+	except OSError:
+		return file_, None
+
+
+def bytes_key(data):
+	"""Cache key for image bytedata"""
+	return hashlib.sha1(data).hexdigest()
+
+
+class PixbufCache:
+	"""
+	LRU cache for scaled pixbufs.
+	Cache size is limited by total memory of pixel data in bytes.
+	"""
+	def __init__(self, budget):
+		self.budget = budget
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+
+	def get(self, key):
+		"""Find pixbuf by key, None if not cached"""
+		pixbuf = self._data.get(key)
+		if pixbuf is not None:
+			self._data.move_to_end(key)
+			self.hits += 1
+		else:
+			self.misses += 1
+
+		logger.debug(
+			"Pixbuf cache %s, hits: %d, misses: %d, items: %d, size: %d bytes",
+			"hit" if pixbuf is not None else "miss", self.hits, self.misses, len(self._data), self.size
+		)
+		return pixbuf
+
+	def put(self, key, pixbuf):
+		"""Save pixbuf to cache, drop least recently used ones if memory budget exceeded"""
+		nbytes = pixbuf.get_byte_length()
+		if nbytes > self.budget:
+			return
+
+		if key in self._data:
+			self.size -= self._data.pop(key).get_byte_length()
+		self._data[key] = pixbuf
+		self.size += nbytes
+
+		while self.size > self.budget:
+			_, old = self._data.popitem(last=False)
+			self.size -= old.get_byte_length()
+
+
+class AsyncLoader:
+	"""
+	Non-blocking pixbuf loader.
+	Image decoding and scaling are done in worker thread, result is sent to callback in main loop.
+	Only the latest request matters, so every new one cancels the previous.
+	Non exclusive loader keeps all requests and sends every result to callback, None on failure.
+	Optional cache is checked before loading and filled with every loaded image.
+	"""
+	def __init__(self, callback, cache=None, exclusive=True):
+		self.callback = callback
+		self.cache = cache
+		self.exclusive = exclusive
+		self.cancellable = None
+		self.pending = 0
+		self._request = None
+		self._last_data = None
+		self._last_key = None
+
+	@property
+	def is_busy(self):
+		return self.pending > 0
+
+	def cancel(self):
+		"""Cancel pending request"""
+		if self.cancellable is not None:
+			self.cancellable.cancel()
+			self.cancellable = None
+
+	def from_bytes_at_scale(self, data, width, height, aspect=True):
+		"""Load pixbuf from bytedata with scaling"""
+		if self._from_cache(self._bytes_key(data), width, height, aspect):
+			return
+
+		stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+		self._load(stream, width, height, aspect)
+
+	def from_file_at_scale(self, file_, width, height, aspect=True):
+		"""Load pixbuf from file with scaling"""
+		if self._from_cache(file_key(file_), width, height, aspect):
+			return
+
+		try:
+			stream = Gio.File.new_for_path(file_).read(None)
+		except GLib.Error as e:
+			logger.error("Fail to open image file '%s':\n%s" % (file_, e))
+			return
+		self._load(stream, width, height, aspect)
+
+	def _bytes_key(self, data):
+		# same image bytes are usually requested many times in a row, so avoid rehashing
+		if data is not self._last_data:
+			self._last_data, self._last_key = data, bytes_key(data)
+		return self._last_key
+
+	def _from_cache(self, source, width, height, aspect):
+		self._request = (source, width, height, aspect)
+		if self.cache is None:
+			return False
+
+		pixbuf = self.cache.get(self._request)
+		if pixbuf is not None:
+			if self.exclusive:
+				self.cancel()
+			self.callback(pixbuf)
+			return True
+		return False
+
+	def _load(self, stream, width, height, aspect):
+		cancellable = Gio.Cancellable()
+		if self.exclusive:
+			self.cancel()
+			self.cancellable = cancellable
+		self.pending += 1
+		GdkPixbuf.Pixbuf.new_from_stream_at_scale_async(
+			stream, width, height, aspect, cancellable, self._on_ready, (cancellable, self._request)
+		)
+
+	# noinspection PyUnusedLocal
+	def _on_ready(self, source, result, data):
+		cancellable, request = data
+		self.pending -= 1
+		try:
+			pixbuf = GdkPixbuf.Pixbuf.new_from_stream_finish(result)
+		except GLib.Error as e:
+			if not cancellable.is_cancelled():
+				logger.error("Fail to load image:\n%s" % e)
+			if not self.exclusive:
+				self.callback(None)
+			return
+
+		if self.cache is not None:
+			self.cache.put(request, pixbuf)
+
+		if not self.exclusive:
+			self.callback(pixbuf)
+		elif cancellable is self.cancellable:
+			self.cancellable = None
+			self.callback(pixbuf)
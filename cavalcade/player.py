@@ -1,18 +1,33 @@
 # -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
 import gi
+import time
 import random
+import itertools
+import collections
+import concurrent.futures
 gi.require_version('Gst', '1.0')
+gi.require_version('GstPbutils', '1.0')
 
-from gi.repository import Gst, GLib, GObject, Gio
+from gi.repository import Gst, GstPbutils, GLib, GObject, Gio
+import cavalcade.pixbuf as pixbuf
+import cavalcade.coverart as coverart
+from cavalcade.common import AttributeDict, name_from_file
+from cavalcade.library import MetadataIndex
 from cavalcade.logger import logger
 
 Gst.init(None)
 
+# single thread for native tag reading, so disk access never blocks main loop
+NATIVE_READER = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="tag-reader")
+
 
-# TODO: separate thread?
 def image_data_from_message(message):
 	"""Get image bytedata from id3 tag message"""
-	taglist = message.parse_tag()
+	return image_data_from_taglist(message.parse_tag())
+
+
+def image_data_from_taglist(taglist):
+	"""Get image bytedata from gstreamer tag list"""
 	is_ok, sample = taglist.get_sample("image")
 	if not is_ok:
 		return None
@@ -24,14 +39,302 @@ def image_data_from_message(message):
 	return data
 
 
+class PlayQueue:
+	"""
+	Ordered set of audio files with constant time membership test, removal and random choice.
+	Removed items leave holes in storage list, which is compacted when holes outnumber files.
+	"""
+	def __init__(self, files=()):
+		self.items = []
+		self.positions = {}
+		self.start = 0
+		for file_ in files:
+			self.add(file_)
+
+	def __len__(self):
+		return len(self.positions)
+
+	def __contains__(self, file_):
+		return file_ in self.positions
+
+	def __iter__(self):
+		return (file_ for file_ in itertools.islice(self.items, self.start, None) if file_ is not None)
+
+	def __bool__(self):
+		return bool(self.positions)
+
+	def add(self, file_):
+		"""Append file to the end of queue, return False if it was queued already"""
+		if file_ in self.positions:
+			return False
+		self.positions[file_] = len(self.items)
+		self.items.append(file_)
+		return True
+
+	def remove(self, file_):
+		"""Remove file from queue, return False if it was not queued"""
+		i = self.positions.pop(file_, None)
+		if i is None:
+			return False
+
+		self.items[i] = None
+		if len(self.items) > 2 * len(self.positions) + 16:
+			self._compact()
+		elif i == self.start:
+			while self.start < len(self.items) and self.items[self.start] is None:
+				self.start += 1
+		return True
+
+	def _compact(self):
+		self.items = list(self)
+		self.positions = {file_: i for i, file_ in enumerate(self.items)}
+		self.start = 0
+
+	def first(self):
+		"""First file in queue"""
+		return self.items[self.start] if self.positions else None
+
+	def choice(self):
+		"""Random file from queue"""
+		if not self.positions:
+			return None
+		while True:
+			file_ = self.items[random.randrange(self.start, len(self.items))]
+			if file_ is not None:
+				return file_
+
+	def successors(self, file_):
+		"""Files after given one in cyclic order, starting from queue beginning if file is not queued"""
+		i = self.positions[file_] + 1 if file_ in self.positions else self.start
+		ordered = itertools.chain(itertools.islice(self.items, i, None), itertools.islice(self.items, self.start, i))
+		return (f for f in ordered if f is not None and f != file_)
+
+
+class TagReader:
+	"""
+	Lightweight tag extraction service.
+	Files are inspected by gstreamer discoverer in its own threads, without opening audio devices.
+	Result with cover image bytedata, duration and base text tags is sent to callback in main loop.
+	In native mode files are parsed by coverart module in background thread first,
+	discoverer is used only when no cover image was found this way.
+	"""
+	def __init__(self, callback, timeout=5, native=False):
+		self.callback = callback
+		self.native = native
+		self.requests = {}
+		self.generation = 0
+
+		self.discoverer = GstPbutils.Discoverer.new(timeout * Gst.SECOND)
+		self.discoverer.connect("discovered", self._on_discovered)
+		self.discoverer.start()
+
+	@property
+	def is_busy(self):
+		return bool(self.requests)
+
+	def read(self, file_):
+		"""Queue file for tag reading"""
+		uri = Gst.filename_to_uri(file_)
+		self.requests[uri] = file_
+		if self.native:
+			NATIVE_READER.submit(self._read_native, uri, file_, self.generation)
+		else:
+			self.discoverer.discover_uri_async(uri)
+
+	def cancel(self):
+		"""Drop all pending requests"""
+		if self.requests:
+			self.generation += 1
+			self.requests.clear()
+			self.discoverer.stop()
+			self.discoverer.start()
+
+	def _read_native(self, uri, file_, generation):
+		tags = coverart.read_tags(file_)
+		GLib.idle_add(self._on_native_read, uri, tags, generation)
+
+	def _on_native_read(self, uri, tags, generation):
+		if generation != self.generation or uri not in self.requests:
+			return False  # canceled request
+
+		if tags is not None and tags.image is not None:
+			self.callback(self.requests.pop(uri), tags)
+		else:
+			self.discoverer.discover_uri_async(uri)
+		return False
+
+	# noinspection PyUnusedLocal
+	def _on_discovered(self, discoverer, info, error):
+		file_ = self.requests.pop(info.get_uri(), None)
+		if file_ is None:
+			return  # canceled request
+
+		tags = AttributeDict(image=None, duration=None, title=None, artist=None, album=None)
+		if info.get_result() == GstPbutils.DiscovererResult.OK:
+			taglist = info.get_tags()
+			if taglist is not None:
+				tags.image = image_data_from_taglist(taglist)
+				for name in ("title", "artist", "album"):
+					is_ok, value = taglist.get_string(name)
+					if is_ok:
+						tags[name] = value
+			tags.duration = info.get_duration()
+		else:
+			logger.warning("Fail to read tags from %s:\n%s" % (file_, error))
+
+		self.callback(file_, tags)
+
+
+class BackgroundStepper:
+	"""
+	Base for low priority processing of file queue.
+	Work is done in steps, each finished by tag reader callback or explicitly,
+	pauses between steps keep cpu usage inside budget (in percents) given by player option.
+	"""
+	def __init__(self, config, budget_option):
+		self.config = config
+		self.budget_option = budget_option
+		self.queue = collections.deque()
+		self.timer = None
+		self.started = None
+		self.reader = None
+
+	@property
+	def is_busy(self):
+		"""Current step is not finished yet"""
+		return self.reader.is_busy
+
+	def _schedule(self, delay=0):
+		if self.timer is None and self.queue and not self.is_busy:
+			self.timer = GLib.timeout_add(delay, self._on_timer, priority=GLib.PRIORITY_LOW)
+
+	def _on_timer(self):
+		self.timer = None
+		self.started = time.monotonic()
+		self._step()
+		return False
+
+	def _step(self):
+		"""Process next portion of queue"""
+		raise NotImplementedError
+
+	def _finish_step(self):
+		"""Schedule next step after pause proportional to the time spent on current one"""
+		elapsed = time.monotonic() - self.started
+		budget = max(self.config["player"][self.budget_option], 1)
+		self._schedule(int(elapsed * 1000 * (100 / budget - 1)))
+
+
+class Prefetcher(BackgroundStepper):
+	"""
+	Low priority background preparation of upcoming tracks.
+	Cover images are extracted for several tracks ahead of current one
+	and used to warm scaled background and autocolor caches,
+	so track change can switch background and color immediately.
+	"""
+	def __init__(self, mainapp, player):
+		super().__init__(mainapp.config, "prefetch_budget")
+		self._mainapp = mainapp
+		self._player = player
+
+		self.covers = {}
+		self.reader = TagReader(self._on_cover, native=True)
+		self.loader = pixbuf.AsyncLoader(self._on_loaded, mainapp.canvas.cache, exclusive=False)
+
+		self._player.connect("current", self.update)
+		self._player.connect("queue-update", self.update)
+		self._player.connect("queue-insert", self.update)
+		self._player.connect("queue-remove", self.update)
+
+	# noinspection PyUnusedLocal
+	def update(self, *args):
+		"""Rebuild list of tracks to prepare"""
+		files = self._player.upcoming(self.config["player"]["lookahead"])
+		keep = set(files + [self._player.current])
+		self.covers = {file_: data for file_, data in self.covers.items() if file_ in keep}
+		self.queue = collections.deque(file_ for file_ in files if file_ not in self.covers)
+		self._schedule()
+
+	@property
+	def is_busy(self):
+		return self.reader.is_busy or self.loader.is_busy
+
+	def _step(self):
+		if self.queue:
+			self.reader.read(self.queue.popleft())
+
+	def _on_cover(self, file_, tags):
+		data = tags.image
+		self.covers[file_] = data
+
+		if data is not None and self.config["image"]["usetag"]:
+			if self.config["color"]["auto"] and hasattr(self._mainapp, "autocolor"):
+				self._mainapp.autocolor.prefetch(data)
+			if self.config["image"]["show"]:
+				self.loader.from_bytes_at_scale(data, *self._mainapp.canvas.background_size())
+				return  # step is finished when image is decoded, so decoding counts against budget
+
+		self._finish_step()
+
+	# noinspection PyUnusedLocal
+	def _on_loaded(self, pixbuf):
+		self._finish_step()
+
+
+class Indexer(BackgroundStepper):
+	"""Background filling of persistent metadata index with playlist files"""
+	STAT_CHUNK = 500  # max number of files checked per step
+
+	def __init__(self, mainapp, player):
+		super().__init__(mainapp.config, "index_budget")
+		self._player = player
+
+		self.index = MetadataIndex(mainapp)
+		self.reader = TagReader(self._on_read)
+
+		self._player.connect("playlist-update", self.update)
+
+	# noinspection PyUnusedLocal
+	def update(self, player, files):
+		"""Check new file list"""
+		self.queue = collections.deque(files)
+		self._schedule()
+
+	def _step(self):
+		for _ in range(self.STAT_CHUNK):
+			if not self.queue:
+				self.index.save()
+				logger.debug("Metadata index is up to date")
+				break
+
+			file_ = self.queue.popleft()
+			if not self.index.is_actual(file_):
+				self.reader.read(file_)
+				break
+		else:
+			self._schedule()
+
+	def _on_read(self, file_, tags):
+		self.index.add(file_, tags)
+		self._player.emit("track-info", file_)
+		self._finish_step()
+
+	def close(self):
+		"""Save index"""
+		self.index.save()
+
+
 class Player(GObject.GObject):
 	"""Simple gstreamer audio player"""
 	__gsignals__ = {
 		"progress": (GObject.SIGNAL_RUN_FIRST, None, (int,)),
 		"playlist-update": (GObject.SIGNAL_RUN_FIRST, None, (object,)),
 		"queue-update": (GObject.SIGNAL_RUN_FIRST, None, (object,)),
+		"queue-insert": (GObject.SIGNAL_RUN_FIRST, None, (object,)),
+		"queue-remove": (GObject.SIGNAL_RUN_FIRST, None, (object,)),
 		"current": (GObject.SIGNAL_RUN_FIRST, None, (object,)),
 		"preview-update": (GObject.SIGNAL_RUN_FIRST, None, (object,)),
+		"track-info": (GObject.SIGNAL_RUN_FIRST, None, (str,)),
 		"playing": (GObject.SIGNAL_RUN_FIRST, None, (bool,)),
 	}
 
@@ -40,7 +343,7 @@ class Player(GObject.GObject):
 		self._mainapp = mainapp
 		self.config = mainapp.config
 		self.playlist = []
-		self.playqueue = []
+		self.playqueue = PlayQueue()
 		self.actions = {}
 
 		self.is_image_updated = True
@@ -48,6 +351,9 @@ class Player(GObject.GObject):
 		self.timer_id = None
 		self._current = None
 		self._is_playing = False
+		self.prefetcher = None
+		self.indexer = None
+		self.spectrum = None
 
 		self.player = Gst.ElementFactory.make('playbin', 'player')
 
@@ -56,12 +362,15 @@ class Player(GObject.GObject):
 		bus.connect("message", self._on_message)
 		bus.connect("message::tag", self._on_message_tag)
 
-		# this is ugly and should be fixed
-		# some fake player object is used to get tag image without playing audio file itself
-		self._fake_player = Gst.ElementFactory.make('playbin', 'player')
-		bus = self._fake_player.get_bus()
-		bus.add_signal_watch()
-		bus.connect("message::tag", self._on_fake_message)
+		# optional visualization of played audio without external capture
+		if self.config["player"]["visualize"]:
+			from cavalcade.analyzer import PlayerSpectrum
+			self.spectrum = PlayerSpectrum(mainapp, self.player)
+			self.connect("playing", lambda player, value: self.spectrum.activate(value))
+
+		# tag image readers for current file and files selected in playlist
+		self.cover_reader = TagReader(self._on_cover_read, native=True)
+		self.preview_reader = TagReader(self._on_preview_read, native=True)
 
 		# actions
 		self.actions["player"] = Gio.SimpleActionGroup()
@@ -74,6 +383,14 @@ class Player(GObject.GObject):
 		next_action.connect("activate", self.play_next)
 		self.actions["player"].add_action(next_action)
 
+		# optional metadata index
+		if self.config["player"]["index"]:
+			self.indexer = Indexer(mainapp, self)
+
+		# optional preparation of upcoming tracks
+		if self.config["player"]["prefetch"]:
+			self.prefetcher = Prefetcher(mainapp, self)
+
 	@property
 	def current(self):
 		return self._current
@@ -137,51 +454,52 @@ class Player(GObject.GObject):
 		if files:
 			self.playlist = files
 
-			self.playqueue = list(queue if queue else files)
+			self.playqueue = PlayQueue(queue if queue else files)
 			self.emit("playlist-update", self.playlist)
 			self.emit("queue-update", self.playqueue)
-			self.load_file(random.choice(self.playqueue) if self.config["player"]["shuffle"] else self.playqueue[0])
+			self.load_file(self.playqueue.choice() if self.config["player"]["shuffle"] else self.playqueue.first())
 
 	def load_file(self, file_):
 		"""Set audio file to play"""
 		if self.current is not None:
-			if self.current in self.playqueue:
-				self.playqueue.remove(self.current)
+			self.remove_from_queue(self.current)
 			self.stop()
 
 		self.is_image_updated = False
 		self.current = file_
 		self.player.set_property('uri', 'file:///' + file_)
-		if file_ not in self.playqueue:
-			self.playqueue.append(file_)
-		self.emit("queue-update", self.playqueue)
+		self.add_to_queue(file_)
+
+		# use prefetched cover image if available or try to read it without waiting for pipeline
+		self.cover_reader.cancel()
+		if self.prefetcher is not None and file_ in self.prefetcher.covers:
+			self.is_image_updated = True
+			self._mainapp.emit("tag-image-update", self.prefetcher.covers[file_])
+		else:
+			self.cover_reader.read(file_)
+
+	def upcoming(self, number):
+		"""Files expected to be played after current one, considering playback without shuffle"""
+		return list(itertools.islice(self.playqueue.successors(self.current), number))
 
 	def add_to_queue(self, *files):
 		"""Add audio file to playback queue"""
-		updated = False
-		for file_ in files:
-			if file_ not in self.playqueue:
-				self.playqueue.append(file_)
-				updated = True
-
-		if updated:
-			self.emit("queue-update", self.playqueue)
+		added = [file_ for file_ in files if self.playqueue.add(file_)]
+		if added:
+			self.emit("queue-insert", added)
 
 	def remove_from_queue(self, *files):
 		"""Remove audio file from playback queue"""
-		updated = False
-		for file_ in files:
-			if file_ in self.playqueue:
-				self.playqueue.remove(file_)
-				updated = True
-
-		if updated:
-			self.emit("queue-update", self.playqueue)
+		removed = [file_ for file_ in files if self.playqueue.remove(file_)]
+		if removed:
+			self.emit("queue-remove", removed)
 
 	def seek(self, value):
 		"""Playback progress manipulation"""
 		if self.duration is not None:
 			point = int(self.duration * value / 1000)
+			if self.spectrum is not None:
+				self.spectrum.clear()
 			self.player.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, point)
 
 	def stop(self):
@@ -201,19 +519,16 @@ class Player(GObject.GObject):
 			logger.debug("No audio file selected")
 		else:
 			if current in self.playqueue:
-				i = self.playqueue.index(current)
-				self.playqueue.remove(current)
+				following = next(self.playqueue.successors(current), None)
+				self.remove_from_queue(current)
 			else:
-				i = 1
+				following = next(itertools.islice(self.playqueue, 1, None), self.playqueue.first())
 			if self.playqueue:
 				if self.config["player"]["shuffle"]:
-					self.load_file(random.choice(self.playqueue))
-				elif i < len(self.playqueue):
-					self.load_file(self.playqueue[i])
+					self.load_file(self.playqueue.choice())
 				else:
-					self.load_file(self.playqueue[0])
+					self.load_file(following)
 				self.play_pause()
-			self.emit("queue-update", self.playqueue)  # fix false update if current not in queue
 
 	# noinspection PyUnusedLocal
 	def play_pause(self, *args):
@@ -233,12 +548,25 @@ class Player(GObject.GObject):
 		"""Volume manipulation"""
 		self.player.set_property('volume', value)
 
-	def fake_tag_reader(self, file_):
-		self._fake_player.set_property('uri', 'file:///' + file_)
-		self._fake_player.set_state(Gst.State.PAUSED)
+	def read_preview(self, file_):
+		"""Read tag image from audio file without playing it, previous request is canceled"""
+		self.preview_reader.cancel()
+		self.preview_reader.read(file_)
+
+	def _on_cover_read(self, file_, tags):
+		# pipeline tag message could be first
+		if file_ == self.current and not self.is_image_updated and tags.image is not None:
+			self.is_image_updated = True
+			self._mainapp.emit("tag-image-update", tags.image)
 
 	# noinspection PyUnusedLocal
-	def _on_fake_message(self, bus, message):
-		data = image_data_from_message(message)
-		self.emit("preview-update", data)
-		self._fake_player.set_state(Gst.State.NULL)
+	def _on_preview_read(self, file_, tags):
+		self.emit("preview-update", tags.image)
+
+	def track_name(self, file_):
+		"""Human readable track name"""
+		return self.indexer.index.track_name(file_) if self.indexer is not None else name_from_file(file_)
+
+	def track_keywords(self, file_):
+		"""Text fields to search track by"""
+		return self.indexer.index.keywords(file_) if self.indexer is not None else (name_from_file(file_),)
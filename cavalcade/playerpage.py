@@ -1,8 +1,234 @@
 # -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
 import cavalcade.pixbuf as pixbuf
 
-from gi.repository import Gtk, Pango
-from cavalcade.common import GuiBase, TreeViewHolder, name_from_file, AttributeDict
+from gi.repository import Gtk, Pango, GObject
+from cavalcade.common import GuiBase, TreeViewHolder, AttributeDict
+from cavalcade.search import SearchIndex
+
+
+class TrackListModel(GObject.Object, Gtk.TreeModel):
+	"""
+	Virtual audio track list model.
+	Rows are plain references to files, track names are calculated on demand when view requests them.
+	Bulk changes (reset, refilter and silent edits) are allowed only while model is detached from view.
+	Visible files are stored in slots, removed rows leave holes which are compacted when they outnumber files.
+	Row number of slot is counted with binary indexed tree, so single track edits and lookups
+	take logarithmic time. Iterators reference slots and are valid until next bulk change or compaction.
+	"""
+	COLUMN_TYPES = (GObject.TYPE_INT, GObject.TYPE_STRING, GObject.TYPE_STRING)
+	INVALID_VALUES = (-1, None, None)
+
+	def __init__(self, namer):
+		super().__init__()
+		self.namer = namer
+		self.files = {}
+		self.filter = None
+		self.stamp = 1
+
+		self.slots = []
+		self.positions = {}  # file to slot
+		self.tree = [0]  # binary indexed tree of visible files number over slots
+		self.length = 0
+		self.holes = 0
+
+	@property
+	def rows(self):
+		"""Visible files"""
+		return [file_ for file_ in self.slots if file_ is not None]
+
+	def _count(self, slot):
+		"""Number of visible files before given slot"""
+		total = 0
+		while slot > 0:
+			total += self.tree[slot]
+			slot -= slot & -slot
+		return total
+
+	def _slot(self, index):
+		"""Slot of visible row with given index, None if there is no such row"""
+		if not 0 <= index < self.length:
+			return None
+		slot, rest = 0, index + 1
+		step = 1 << (len(self.tree) - 1).bit_length() - 1
+		while step:
+			if slot + step < len(self.tree) and self.tree[slot + step] < rest:
+				slot += step
+				rest -= self.tree[slot]
+			step >>= 1
+		return slot
+
+	def _add_slot(self, file_):
+		i = len(self.tree)
+		self.tree.append(1 + self._count(i - 1) - self._count(i - (i & -i)))
+		self.positions[file_] = len(self.slots)
+		self.slots.append(file_)
+		self.length += 1
+
+	def _remove_slot(self, slot):
+		self.positions.pop(self.slots[slot])
+		self.slots[slot] = None
+		i = slot + 1
+		while i < len(self.tree):
+			self.tree[i] -= 1
+			i += i & -i
+		self.length -= 1
+		self.holes += 1
+
+	def _build(self, rows):
+		self.slots = rows
+		self.positions = {file_: i for i, file_ in enumerate(rows)}
+		self.tree = [0] + [1] * len(rows)
+		for i in range(1, len(self.tree)):
+			parent = i + (i & -i)
+			if parent < len(self.tree):
+				self.tree[parent] += self.tree[i]
+		self.length = len(rows)
+		self.holes = 0
+		self.invalidate()
+
+	def _iter(self, slot):
+		if slot is not None:
+			treeiter = Gtk.TreeIter()
+			treeiter.stamp = self.stamp
+			treeiter.user_data = slot + 1  # zero pointer is returned back as None
+			return True, treeiter
+		return False, None
+
+	def _iter_slot(self, treeiter):
+		"""Slot referenced by iterator, None if iterator is outdated"""
+		if treeiter.stamp != self.stamp:
+			return None
+		slot = treeiter.user_data - 1
+		return slot if 0 <= slot < len(self.slots) and self.slots[slot] is not None else None
+
+	def reset(self, files):
+		"""Replace all files"""
+		self.files = dict.fromkeys(files)
+		self.refilter()
+
+	def set_filter(self, func, narrow=False):
+		"""
+		Set files filter function, None to show all files.
+		Narrowing filter passes only files which are visible already, so only visible rows are checked.
+		"""
+		self.filter = func
+		self.refilter(narrow)
+
+	def refilter(self, narrow=False):
+		"""Rebuild visible rows"""
+		if self.filter is None:
+			self._build(list(self.files))
+		else:
+			self._build([f for f in (self.rows if narrow else self.files) if self.filter(f)])
+
+	def invalidate(self):
+		"""Mark all existing iters as outdated"""
+		self.stamp = self.stamp % 0x7fffffff + 1
+
+	def find(self, file_):
+		"""Get row index for file, None if it is not visible"""
+		slot = self.positions.get(file_)
+		return self._count(slot) if slot is not None else None
+
+	def append(self, files, notify=True):
+		"""Add files to the end of model"""
+		for file_ in files:
+			if file_ in self.files:
+				continue
+			self.files[file_] = None
+			if self.filter is None or self.filter(file_):
+				self._add_slot(file_)
+				if notify:
+					self.row_inserted(Gtk.TreePath(self.length - 1), self._iter(len(self.slots) - 1)[1])
+		if not notify:
+			self.invalidate()
+
+	def remove(self, files, notify=True):
+		"""Remove files from model"""
+		if not notify:
+			for file_ in files:
+				self.files.pop(file_, None)
+			self.refilter()
+			return
+
+		for file_ in files:
+			if file_ not in self.files:
+				continue
+			del self.files[file_]
+			slot = self.positions.get(file_)
+			if slot is not None:
+				index = self._count(slot)
+				self._remove_slot(slot)
+				self.row_deleted(Gtk.TreePath(index))
+
+		if self.holes > self.length + 16:
+			self._build(self.rows)
+
+	# tree model interface
+	def do_get_flags(self):
+		return Gtk.TreeModelFlags.LIST_ONLY
+
+	def do_get_n_columns(self):
+		return len(self.COLUMN_TYPES)
+
+	def do_get_column_type(self, index):
+		return self.COLUMN_TYPES[index]
+
+	def do_get_iter(self, path):
+		indices = path.get_indices()
+		return self._iter(self._slot(indices[0])) if len(indices) == 1 else (False, None)
+
+	def do_get_path(self, treeiter):
+		slot = self._iter_slot(treeiter)
+		return Gtk.TreePath(self._count(slot)) if slot is not None else None
+
+	def do_get_value(self, treeiter, column):
+		slot = self._iter_slot(treeiter)
+		if slot is None:
+			return self.INVALID_VALUES[column]
+		if column == 0:
+			return self._count(slot)
+		elif column == 1:
+			return self.namer(self.slots[slot])
+		else:
+			return self.slots[slot]
+
+	def do_iter_next(self, treeiter):
+		slot = self._iter_slot(treeiter)
+		if slot is not None:
+			for i in range(slot + 1, len(self.slots)):
+				if self.slots[i] is not None:
+					treeiter.user_data = i + 1
+					return True
+		treeiter.stamp = 0
+		return False
+
+	def do_iter_previous(self, treeiter):
+		slot = self._iter_slot(treeiter)
+		if slot is not None:
+			for i in range(slot - 1, -1, -1):
+				if self.slots[i] is not None:
+					treeiter.user_data = i + 1
+					return True
+		treeiter.stamp = 0
+		return False
+
+	def do_iter_children(self, parent):
+		return self._iter(self._slot(0)) if parent is None else (False, None)
+
+	# noinspection PyUnusedLocal
+	def do_iter_has_child(self, treeiter):
+		return False
+
+	def do_iter_n_children(self, treeiter):
+		return self.length if treeiter is None else 0
+
+	def do_iter_nth_child(self, parent, n):
+		return self._iter(self._slot(n)) if parent is None else (False, None)
+
+	# noinspection PyUnusedLocal
+	def do_iter_parent(self, child):
+		return False, None
 
 
 class PlayerPage(GuiBase):
@@ -13,6 +239,7 @@ class PlayerPage(GuiBase):
 		self.current = None
 		self.playlist = []
 		self.playqueue = []
+		self.filter_text = ""  # search text of currently applied filter
 
 		elements = (
 			"mainbox", "play-button", "seek-scale", "playlist-treeview", "playlist-selection", "preview-image",
@@ -23,6 +250,7 @@ class PlayerPage(GuiBase):
 
 		# some gui constants
 		self.TRACK_STORE = AttributeDict(INDEX=0, NAME=1, FILE=2)
+		self.BULK_EDIT = 100  # detach store from view when editing more rows than this
 		self.PLAY_BUTTON_DATA = {
 			False: Gtk.Image(icon_name="media-playback-start-symbolic"),
 			True: Gtk.Image(icon_name="media-playback-pause-symbolic")
@@ -41,6 +269,7 @@ class PlayerPage(GuiBase):
 		# get preview widget height
 		pz = self.gui["preview-image"].get_preferred_size()[1]
 		self.preview_size = pz.height - 2
+		self.preview_loader = pixbuf.AsyncLoader(self.gui["preview-image"].set_from_pixbuf)
 		self.update_default_preview()
 
 		# playlist view setup
@@ -48,16 +277,16 @@ class PlayerPage(GuiBase):
 		self.treelock = TreeViewHolder(self.treeview)
 		for i, title in enumerate(("Index", "Name", "File")):
 			column = Gtk.TreeViewColumn(title, Gtk.CellRendererText(ellipsize=Pango.EllipsizeMode.END), text=i)
+			column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
 			self.treeview.append_column(column)
 			if i != self.TRACK_STORE.NAME:
 				column.set_visible(False)
+		self.treeview.set_fixed_height_mode(True)
 
-		self.store = Gtk.ListStore(int, str, str)
-		self.store_filter = self.store.filter_new()
-		self.store_filter.set_visible_func(self.playlist_filter_func)
-		self.search_text = None
+		self.store = TrackListModel(self._mainapp.player.track_name)
+		self.search = SearchIndex(self._mainapp.player.track_keywords)
 
-		self.treeview.set_model(self.store_filter)
+		self.treeview.set_model(self.store)
 
 		# list view button
 		list_radio_button = "queue-radiobutton" if self._mainapp.config["player"]["showqueue"] else "list-radiobutton"
@@ -76,7 +305,7 @@ class PlayerPage(GuiBase):
 		self.gui["solo-action-button"].connect("clicked", self.on_solo_button_click)
 		self.gui["playlist-treeview"].connect("row_activated", self.on_track_activated)
 		self.gui["volumebutton"].connect("value-changed", self.on_volumebuton_changed)
-		self.gui["list-searchentry"].connect("activate", self.on_search_active)
+		self.gui["list-searchentry"].connect("search-changed", self.on_search_active)
 		self.gui["list-searchentry"].connect("icon-release", self.on_search_reset)
 		self.gui["shuffle-button"].connect("toggled", self.on_shuffle_button_toggle)
 		self.seek_handler_id = self.gui["seek-scale"].connect("value-changed", self.on_seekscale_changed)
@@ -85,8 +314,11 @@ class PlayerPage(GuiBase):
 		self._mainapp.player.connect("progress", self.on_audio_progress)
 		self._mainapp.player.connect("playlist-update", self.on_playlist_update)
 		self._mainapp.player.connect("queue-update", self.on_playqueue_update)
+		self._mainapp.player.connect("queue-insert", self.on_playqueue_insert)
+		self._mainapp.player.connect("queue-remove", self.on_playqueue_remove)
 		self._mainapp.player.connect("current", self.on_current_change)
 		self._mainapp.player.connect("preview-update", self.on_preview_update)
+		self._mainapp.player.connect("track-info", self.on_track_info)
 		self._mainapp.player.connect("playing", self.on_play_state_update)
 
 		self._mainapp.connect("default-image-update", self.update_default_preview)
@@ -110,62 +342,91 @@ class PlayerPage(GuiBase):
 			self.gui[button_name].set_image(data.images[i])
 			self.gui[button_name].set_tooltip_text(data.tooltip[i])
 
-	# noinspection PyUnusedLocal
-	def playlist_filter_func(self, model, treeiter, data):
-		"""Function to filter current track list by search text"""
-		if not self.search_text:
-			return True
-		else:
-			return self.search_text.lower() in model[treeiter][self.TRACK_STORE.NAME].lower()
-
 	def get_filtered_files(self):
 		"""Get list of files considering search filter"""
-		return [row[self.TRACK_STORE.FILE] for row in self.store_filter]
+		return list(self.store.rows)
 
 	def highlight_current(self):
 		"""Select current playing track if available"""
-		files = self.get_filtered_files()
-		if self.current in files:
-			index = files.index(self.current)
+		index = self.store.find(self.current)
+		if index is not None:
 			self.treeview.set_cursor(index)
 		else:
 			self.gui["playlist-selection"].unselect_all()
 
 	def filter_by_search(self):
-		"""Filter current track list by search text"""
-		self.search_text = self.gui["list-searchentry"].get_text()
+		"""Filter current track list by search text, long lists are searched in background"""
+		text = self.gui["list-searchentry"].get_text().lower()
+		if text:
+			self.search.search_async(text, lambda found: self.apply_filter(text, found))
+		else:
+			self.search.cancel_search()
+			self.apply_filter(text, None)
+
+	def apply_filter(self, text, found):
+		"""Show only found files, None to show all"""
+		# result for extended search text can't contain anything not shown already
+		narrow = bool(self.filter_text) and self.filter_text in text
 		with self.gui["playlist-selection"].handler_block(self.sel_handler_id):
-			self.store_filter.refilter()
+			with self.treelock:
+				self.store.set_filter(found.__contains__ if found is not None else None, narrow)
 			self.gui["playlist-selection"].unselect_all()
+		self.filter_text = text
+		self.highlight_current()
 
 	def rebuild_store(self, data):
 		"""Update audio track store"""
 		with self.treelock:
-			self.store.clear()
-			for i, file_ in enumerate(data):
-				self.store.append([i, name_from_file(file_), file_])
+			self.store.reset(data)
 		self.highlight_current()
 
+	def edit_store(self, action, files):
+		"""Apply incremental change to audio track store"""
+		if len(files) > self.BULK_EDIT:
+			with self.treelock:
+				action(files, notify=False)
+		else:
+			action(files)
+
 	# gui handlers
 	# noinspection PyUnusedLocal,PyUnusedLocal
 	def on_track_activated(self, tree, path, column):
-		treeiter = self.store_filter.get_iter(path)
-		file_ = self.store_filter[treeiter][self.TRACK_STORE.FILE]
+		file_ = self.store[path][self.TRACK_STORE.FILE]
 		self._mainapp.player.load_file(file_)
 		self._mainapp.player.play_pause()
 
 	# noinspection PyUnusedLocal
 	def on_playlist_update(self, player, plist):
 		self.playlist = plist
+		self.search.extend(plist)
 		if not self._mainapp.config["player"]["showqueue"]:
 			self.rebuild_store(plist)
 
 	# noinspection PyUnusedLocal
 	def on_playqueue_update(self, player, play_queue):
 		self.playqueue = play_queue
+		self.search.extend(play_queue)
 		if self._mainapp.config["player"]["showqueue"]:
 			self.rebuild_store(play_queue)
 
+	# noinspection PyUnusedLocal
+	def on_playqueue_insert(self, player, files):
+		self.search.extend(files)
+		if self._mainapp.config["player"]["showqueue"]:
+			self.edit_store(self.store.append, files)
+			if self.current in files:
+				self.highlight_current()
+
+	# noinspection PyUnusedLocal
+	def on_playqueue_remove(self, player, files):
+		if self._mainapp.config["player"]["showqueue"]:
+			self.edit_store(self.store.remove, files)
+
+	# noinspection PyUnusedLocal
+	def on_track_info(self, player, file_):
+		self.search.add(file_, *self._mainapp.player.track_keywords(file_))
+		self.treeview.queue_draw()  # track names are requested by view on demand
+
 	# noinspection PyUnusedLocal
 	def on_playbutton_click(self, button):
 		self._mainapp.player.play_pause()
@@ -189,7 +450,7 @@ class PlayerPage(GuiBase):
 	def on_current_change(self, player, current):
 		self.current = current
 		if current is not None:
-			self.gui["play-button"].set_tooltip_text("Playing: %s" % name_from_file(current))
+			self.gui["play-button"].set_tooltip_text("Playing: %s" % self._mainapp.player.track_name(current))
 			self.highlight_current()
 		else:
 			self.gui["play-button"].set_tooltip_text("Playing: none")
@@ -198,22 +459,23 @@ class PlayerPage(GuiBase):
 		model, sel = selection.get_selected()
 		if sel is not None:
 			file_ = model[sel][self.TRACK_STORE.FILE]
-			self._mainapp.player.fake_tag_reader(file_)
+			self._mainapp.player.read_preview(file_)
 
 	# noinspection PyUnusedLocal
 	def on_preview_update(self, player, bytedata):
-		pb = pixbuf.from_bytes_at_scale(bytedata, -1, self.preview_size) if bytedata is not None else self.preview
-		self.gui["preview-image"].set_from_pixbuf(pb)
+		if bytedata is not None:
+			self.preview_loader.from_bytes_at_scale(bytedata, -1, self.preview_size)
+		else:
+			self.preview_loader.cancel()
+			self.gui["preview-image"].set_from_pixbuf(self.preview)
 
 	# noinspection PyUnusedLocal
 	def on_search_active(self, *args):
 		self.filter_by_search()
-		self.highlight_current()
 
 	# noinspection PyUnusedLocal
 	def on_search_reset(self, *args):
 		self.gui["list-searchentry"].set_text("")
-		self.on_search_active()
 
 	# noinspection PyUnusedLocal
 	def on_listview_radio_button_switch(self, button, active, showqueue):
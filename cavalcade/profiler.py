@@ -0,0 +1,76 @@
+# -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+import os
+import sys
+import threading
+import collections
+
+from cavalcade.logger import logger
+
+
+class SamplingProfiler:
+	"""
+	Statistical profiler for all python threads of current process.
+	Stacks are sampled from separate thread and counted in collapsed format
+	("thread;outer;...;inner count" per line), suitable for flamegraph.pl, speedscope and similar tools.
+	"""
+	def __init__(self, path, interval=0.005):
+		self.path = path
+		self.interval = interval
+		self.stacks = collections.Counter()
+		self.samples = 0
+		self.thread = None
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._labels = {}
+
+	def _label(self, code):
+		label = self._labels.get(code)
+		if label is None:
+			label = "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+			self._labels[code] = label
+		return label
+
+	def start(self):
+		"""Launch sampling thread"""
+		self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+		self.thread.start()
+		logger.info("Sampling profiler started, output file %s", self.path)
+
+	def _run(self):
+		while not self._stopped.wait(self.interval):
+			self.sample()
+
+	def sample(self):
+		"""Save current stacks of all threads except profiler one"""
+		names = {thread.ident: thread.name for thread in threading.enumerate()}
+		own = threading.get_ident()
+		with self._lock:
+			for ident, frame in sys._current_frames().items():
+				if ident == own:
+					continue
+				stack = []
+				while frame is not None:
+					stack.append(self._label(frame.f_code))
+					frame = frame.f_back
+				stack.append(names.get(ident, "thread-%d" % ident))
+				self.stacks[";".join(reversed(stack))] += 1
+			self.samples += 1
+
+	def save(self):
+		"""Write collected stacks to output file"""
+		with self._lock:
+			lines = ["%s %d\n" % (stack, count) for stack, count in sorted(self.stacks.items())]
+			samples = self.samples
+		try:
+			with open(self.path, "w") as fp:
+				fp.writelines(lines)
+			logger.info("Profile saved to %s, %d samples", self.path, samples)
+		except OSError:
+			logger.exception("Fail to save profile")
+
+	def stop(self):
+		"""Stop sampling and save result"""
+		self._stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+		self.save()
@@ -0,0 +1,141 @@
+# -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+from gi.repository import GLib
+from cavalcade.logger import logger
+
+
+def trigrams(text):
+	"""Set of all three character substrings"""
+	return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+	"""
+	Case insensitive substring search over items text fields with trigram index.
+	Items can be indexed in background, not yet indexed ones are checked directly.
+	Result of previous query is narrowed when new query extends it.
+	Asynchronous search checks big candidate lists in idle steps, so typing is not blocked.
+	"""
+	CHUNK = 200  # max number of items indexed per idle step
+	SCAN_CHUNK = 5000  # max number of items checked per idle step
+
+	def __init__(self, describe=None):
+		self.describe = describe  # function to get text fields for item
+		self.texts = {}
+		self.grams = {}
+		self.pending = {}
+		self.last = (None, None)
+		self.timer = None
+		self.scan_timer = None
+
+	def _text(self, item):
+		text = self.texts.get(item)
+		return text if text is not None else self._join(self.describe(item))
+
+	@staticmethod
+	def _join(fields):
+		return "\n".join(field for field in fields if field).lower()
+
+	def add(self, item, *fields):
+		"""Index item by given text fields"""
+		self.remove(item)
+		text = self._join(fields)
+		self.texts[item] = text
+		for gram in trigrams(text):
+			self.grams.setdefault(gram, set()).add(item)
+		self.last = (None, None)
+
+	def remove(self, item):
+		"""Remove item from index"""
+		self.pending.pop(item, None)
+		text = self.texts.pop(item, None)
+		if text is not None:
+			for gram in trigrams(text):
+				self.grams[gram].discard(item)
+		if self.last[1] is not None:
+			self.last[1].discard(item)
+
+	def clear(self):
+		"""Remove all items"""
+		self.cancel_search()
+		if self.timer is not None:
+			GLib.source_remove(self.timer)
+			self.timer = None
+		self.texts, self.grams, self.pending = {}, {}, {}
+		self.last = (None, None)
+
+	def extend(self, items):
+		"""Schedule items indexing in background"""
+		for item in items:
+			if item not in self.texts:
+				self.pending[item] = None
+		self.last = (None, None)
+
+		if self.timer is None and self.pending:
+			self.timer = GLib.idle_add(self._step, priority=GLib.PRIORITY_LOW)
+
+	def _step(self):
+		for _ in range(min(self.CHUNK, len(self.pending))):
+			item, _ = self.pending.popitem()
+			self.add(item, *self.describe(item))
+
+		if self.pending:
+			return True
+
+		logger.debug("Search index is ready, %d items", len(self.texts))
+		self.timer = None
+		return False
+
+	def _candidates(self, query):
+		last_query, last_result = self.last
+		if last_query is not None and last_query in query:
+			return list(last_result)
+
+		if len(query) >= 3:
+			sets = sorted((self.grams.get(gram, set()) for gram in trigrams(query)), key=len)
+			candidates = sets[0].intersection(*sets[1:])
+		else:
+			candidates = self.texts
+		return list(candidates) + list(self.pending)
+
+	def _match(self, query, items):
+		return {item for item in items if query in self._text(item)}
+
+	def search(self, query):
+		"""Get set of items which text contains query"""
+		self.cancel_search()
+		query = query.lower()
+		result = self._match(query, self._candidates(query))
+		self.last = (query, result)
+		return result
+
+	def search_async(self, query, callback):
+		"""
+		Find items which text contains query and send result set to callback.
+		Small candidate lists are checked at once, previous unfinished search is canceled.
+		"""
+		self.cancel_search()
+		query = query.lower()
+		candidates = self._candidates(query)
+		if len(candidates) <= self.SCAN_CHUNK:
+			result = self._match(query, candidates)
+			self.last = (query, result)
+			callback(result)
+		else:
+			self.scan_timer = GLib.idle_add(self._scan_step, query, candidates, set(), callback)
+
+	def _scan_step(self, query, candidates, result, callback):
+		result.update(self._match(query, candidates[-self.SCAN_CHUNK:]))
+		del candidates[-self.SCAN_CHUNK:]
+		if candidates:
+			return True
+
+		self.scan_timer = None
+		self.last = (query, result)
+		callback(result)
+		return False
+
+	def cancel_search(self):
+		"""Stop unfinished asynchronous search"""
+		if self.scan_timer is not None:
+			GLib.source_remove(self.scan_timer)
+			self.scan_timer = None
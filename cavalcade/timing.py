@@ -0,0 +1,95 @@
+# -*- Mode: Python; indent-tabs-mode: t; python-indent: 4; tab-width: 4 -*-
+import math
+import threading
+
+from gi.repository import GLib
+
+
+class Histogram:
+	"""
+	Duration histogram with logarithmic bins.
+	Four bins per octave give about 20% precision for percentiles at constant memory.
+	"""
+	STEPS = 4  # bins per octave
+	SIZE = 100  # up to about 30 seconds in microseconds
+
+	def __init__(self):
+		self.bins = [0] * self.SIZE
+		self.count = 0
+
+	def add(self, value):
+		"""Save duration in microseconds"""
+		i = int(math.log2(value) * self.STEPS) + 1 if value >= 1 else 0
+		self.bins[min(i, self.SIZE - 1)] += 1
+		self.count += 1
+
+	def percentile(self, p):
+		"""Upper bound of bin which contains given percentile, microseconds"""
+		if not self.count:
+			return 0
+		target, total = self.count * p / 100, 0
+		for i, number in enumerate(self.bins):
+			total += number
+			if total >= target:
+				return 2 ** (i / self.STEPS)
+		return 2 ** (self.SIZE / self.STEPS)
+
+
+class FrameTiming:
+	"""
+	Spectrum frames timing statistics.
+	Stages are measured in microseconds of monotonic time, frame latency is counted
+	from the moment frame was read till the end of its drawing.
+	Wait stage is the time reader was blocked on stream, so it shows source frame rate rather than own cost.
+	"""
+	STAGES = ("wait", "decode", "dispatch", "draw", "latency")
+
+	def __init__(self):
+		self.enabled = False
+		self.period = 1000000 / 60  # expected frame interval, used to count late frames
+		self._lock = threading.Lock()
+		self._pending = None
+		self.reset()
+
+	def reset(self):
+		"""Start new statistics period"""
+		with self._lock:
+			self.histograms = {stage: Histogram() for stage in self.STAGES}
+			self.frames = 0
+			self.late = 0
+			self.started = GLib.get_monotonic_time()
+
+	def add(self, stage, value):
+		"""Save stage duration"""
+		with self._lock:
+			self.histograms[stage].add(value)
+
+	def dispatched(self, stamp):
+		"""Frame read at given time was taken by main loop"""
+		now = GLib.get_monotonic_time()
+		self.add("dispatch", now - stamp)
+		self._pending = stamp
+
+	def drawn(self, start):
+		"""Drawing started at given time is finished"""
+		now = GLib.get_monotonic_time()
+		self.add("draw", now - start)
+		if self._pending is not None:
+			latency = now - self._pending
+			with self._lock:
+				self.histograms["latency"].add(latency)
+				self.frames += 1
+				self.late += latency > self.period
+			self._pending = None
+
+	def summary(self):
+		"""Get statistics for the period and start new one"""
+		with self._lock:
+			elapsed = max(GLib.get_monotonic_time() - self.started, 1)
+			data = dict(
+				fps = self.frames * 1000000 / elapsed,
+				late = self.late,
+				stages = {stage: (h.percentile(50), h.percentile(99), h.count) for stage, h in self.histograms.items()},
+			)
+		self.reset()
+		return data
@@ -131,8 +131,7 @@ class VisualPage(GuiBase):
 	def on_draw_spinbutton_changed(self, button, key):
 		type_ = float if key == "scale" else int
 		self.config["draw"][key] = type_(button.get_value())
-		if key in ("padding", "zero"):
-			self._mainapp.draw.size_update()
+		self._mainapp.draw.size_update()
 
 	def on_offset_spinbutton_changed(self, button):
 		self.config["offset"][self.offset_current] = int(button.get_value())